@@ -4,11 +4,81 @@ from tqdm import tqdm
 import base64
 import json
 import random
+import threading
 
 from utils import anonymizeId, makeAbsPath
 
 from getGlobalLogger import logger
 
+# 单次请求的超时时间 (连接, 读取), 单位秒
+REQUEST_TIMEOUT = (5, 15)
+# 遇到限流、5xx 或网络错误时的最大重试次数
+MAX_RETRIES = 3
+# 重试的基础等待时间和最长等待时间 (秒), 每次重试翻倍并加入随机抖动
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+# 各类接口每秒允许的请求数 (初始值, 最小值, 最大值)
+ENDPOINT_RATES = {
+    "login":    (0.5, 0.1, 1),
+    "list":     (10, 1, 20),
+    "write":    (5, 0.5, 10),
+    "download": (5, 0.5, 10),
+}
+# 接口所属的限速类别, 未列出的接口归为 "write"
+ENDPOINT_CLASSES = {
+    "SignIn":       "login",
+    "Logout":       "login",
+    "UserInfo":     "list",
+    "FileList":     "list",
+    "ShareList":    "list",
+    "DownloadInfo": "download",
+}
+# 可以安全重复发送的 POST 接口 (GET 请求都可以重试); 其余 POST 接口读取超时后服务器可能已经执行, 不再重试
+IDEMPOTENT_ACTIONS = {"DownloadInfo"}
+# 请求成功时每秒请求数的增量, 被限流时请求数减半 (AIMD)
+RATE_INCREASE_STEP = 0.1
+
+# 当前线程中请求的截止时间 (time.monotonic()), 超过后不再发送请求和重试; 同一个 Pan123 对象会被多个线程共用, 因此按线程保存
+_requestDeadline = threading.local()
+
+def setRequestDeadline(deadline):
+    # 设置当前线程之后所有请求 (含重试和退避等待) 的截止时间, 传入 None 表示不限制
+    _requestDeadline.value = deadline
+
+class TokenBucket:
+    # 令牌桶限速器, 速率根据请求结果自适应调整: 成功时缓慢提高, 被限流时减半
+    def __init__(self, rate, minRate, maxRate):
+        self.rate = rate
+        self.minRate = minRate
+        self.maxRate = maxRate
+        # 允许的突发请求数
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.lastTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # 取得一个令牌, 令牌不足时等待
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.lastTime) * self.rate)
+                self.lastTime = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                waitTime = (1 - self.tokens) / self.rate
+            time.sleep(waitTime)
+
+    def onSuccess(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + RATE_INCREASE_STEP)
+
+    def onThrottle(self):
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
 class Pan123:
     # Refer: https://github.com/AlistGo/alist/blob/main/drivers/123/util.go
     
@@ -29,6 +99,14 @@ class Pan123:
         self.listFilesVisited = {}
         # 用于记录self.listShare访问过的文件夹：{文件夹Id: 文件夹名称}
         self.listShareVisited = {}
+        # 复用连接 (keep-alive)
+        self.session = requests.Session()
+        # 每类接口一个限速器, 列表接口的初始速率由 sleepTime 决定
+        self.rateLimiters = {}
+        for endpointClass, (rate, minRate, maxRate) in ENDPOINT_RATES.items():
+            if endpointClass == "list" and sleepTime > 0:
+                rate = min(1 / sleepTime, maxRate)
+            self.rateLimiters[endpointClass] = TokenBucket(rate, minRate, maxRate)
     
     def getActionUrl(self, actionName):
         # 执行各类操作的Url
@@ -56,6 +134,89 @@ class Pan123:
         # 返回对应操作的API地址, 如果不存在则返回None
         return apis.get(actionName, None)
 
+    def getRateStats(self):
+        # 各类接口当前的每秒请求数
+        return {endpointClass: round(limiter.rate, 2) for endpointClass, limiter in self.rateLimiters.items()}
+
+    def _request(self, method, actionName, **kwargs):
+        # 所有 API 请求的统一入口: 按接口类别限速, 设置超时, 遇到限流/5xx/网络错误时退避重试 (非幂等请求读取超时时不重试)
+        # 当前线程设置了截止时间 (setRequestDeadline) 时, 总耗时不超过截止时间, 到期后抛出 requests.Timeout
+        # 返回解析后的 JSON; 重试用尽后, 能解析出 JSON 时返回最后一次的结果, 否则抛出异常
+        limiter = self.rateLimiters[ENDPOINT_CLASSES.get(actionName, "write")]
+        deadline = getattr(_requestDeadline, "value", None)
+        for attempt in range(MAX_RETRIES + 1):
+            limiter.acquire()
+            retryAfter = None
+            timeout = REQUEST_TIMEOUT
+            if deadline is not None:
+                # 单次请求的超时不超过剩余时间
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise requests.Timeout(f"{actionName} 请求超出截止时间")
+                timeout = (min(REQUEST_TIMEOUT[0], remaining), min(REQUEST_TIMEOUT[1], remaining))
+            try:
+                response = self.session.request(method, self.getActionUrl(actionName), timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                # 连接超时说明请求未发出, 读取超时时请求可能已被执行, 只重试幂等的请求
+                if isinstance(e, requests.Timeout) and not isinstance(e, requests.ConnectTimeout) and not self._isIdempotent(method, actionName):
+                    raise
+                logger.warning(f"{actionName} 请求失败, 准备重试: {e}")
+            else:
+                if response.status_code == 429 or response.status_code >= 500:
+                    retryAfter = response.headers.get("Retry-After")
+                    if attempt == MAX_RETRIES:
+                        limiter.onThrottle()
+                        # 状态码为 429 或 5xx, 一定会抛出 HTTPError
+                        response.raise_for_status()
+                    logger.warning(f"{actionName} 返回 HTTP {response.status_code}, 准备重试")
+                else:
+                    response_data = response.json()
+                    if not self._isThrottled(response_data):
+                        limiter.onSuccess()
+                        return response_data
+                    if attempt == MAX_RETRIES:
+                        limiter.onThrottle()
+                        return response_data
+                    logger.warning(f"{actionName} 被限流, 准备重试: {json.dumps(response_data, ensure_ascii=False)}")
+            limiter.onThrottle()
+            # 指数退避 + 随机抖动, 服务器给出 Retry-After 时以其为准
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if retryAfter and retryAfter.isdigit():
+                delay = max(delay, min(int(retryAfter), BACKOFF_MAX))
+            if deadline is not None:
+                # 等待到截止时间后, 下一次循环会直接抛出超时
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            time.sleep(delay)
+
+    @staticmethod
+    def _isIdempotent(method, actionName):
+        return method == "GET" or actionName in IDEMPOTENT_ACTIONS
+
+    @staticmethod
+    def _isThrottled(response_data):
+        # 123云盘限流时 HTTP 状态码可能仍是 200, 需要检查返回的 code 和 message
+        if not isinstance(response_data, dict):
+            return False
+        return response_data.get("code") == 429 or "频繁" in str(response_data.get("message", ""))
+
+    def _getErrorType(self, response_data):
+        # 请求失败的原因 (createFolder、uploadFile、downloadFile 失败时放在返回值的 errorType 中):
+        # "upstream": 网络错误、5xx、限流等123云盘自身的问题; "unauthorized": accessToken 失效;
+        # "folderMissing": 上传的目标文件夹不存在; "rejected": 请求本身被拒绝 (如秒传失败、文件被屏蔽)
+        if self._isThrottled(response_data):
+            return "upstream"
+        if response_data.get("code") == 401:
+            return "unauthorized"
+        return "rejected"
+
+    @staticmethod
+    def _isFolderMissing(response_data):
+        # 123云盘没有专门的错误码, 通过提示信息判断 (如 "父级目录不存在"、"文件夹已被删除")
+        message = str(response_data.get("message", ""))
+        return ("目录" in message or "文件夹" in message) and ("不存在" in message or "删除" in message)
+
     def doLogin(self, username, password):
         # 登录操作
         # 如果包含'@'且'@'后面有'.'，则认为是邮箱格式
@@ -82,11 +243,11 @@ class Pan123:
 			"app-version": "3",
 		}
         try:
-            response_data = requests.post(
-                url = self.getActionUrl("SignIn"),
+            response_data = self._request(
+                "POST", "SignIn",
                 headers = headers,
                 json = payload
-            ).json()
+            )
             # sendRequest方法会处理检查API响应中的'code'字段（登录成功时期望值为200）
             # 如果登录成功，'code'将是200
             token = response_data.get("data", {}).get("token") # 从响应数据中提取token
@@ -116,10 +277,10 @@ class Pan123:
         # 注销操作
         # 发送注销请求
         try:
-            response_data = requests.post(
-                url = self.getActionUrl("Logout"),
+            response_data = self._request(
+                "POST", "Logout",
                 headers = self.headers
-            ).json()
+            )
             # sendRequest方法会处理检查API响应中的'code'字段（注销成功时期望值为200）
             if response_data.get("code") == 200:
                 self.accessToken = None
@@ -169,12 +330,11 @@ class Pan123:
                 body.update({"Page": f"{page}"})
                 logger.debug(f"listFiles: 正在获取第 {page} 页, parentFileId: {parentFileId}")
                 # 发送请求
-                time.sleep(self.sleepTime())
-                response_data = requests.get(
-                    url = self.getActionUrl("FileList"),
+                response_data = self._request(
+                    "GET", "FileList",
                     headers = self.headers,
                     params = body
-                ).json()
+                )
                 if response_data.get("code") == 0:
                     response_data = response_data.get("data")
                     # 把文件列表添加到ALL_FILES
@@ -183,10 +343,7 @@ class Pan123:
                     if (response_data.get("Next") == "-1") or (len(response_data.get("InfoList")) == 0):
                         logger.debug(f"listFiles: 已是最后一页 (parentFileId: {parentFileId}, page: {page})")
                         break
-                    # 否则进入下一页 (等待 self.sleepTime 秒, 防止被封)
-                    else:
-                        logger.debug(f"listFiles: 等待 {self.sleepTime()} 秒后进入下一页 (parentFileId: {parentFileId}, page: {page})")
-                        time.sleep(self.sleepTime())
+                    # 否则进入下一页 (self._request 会按限速等待, 防止被封)
                 else:
                     logger.warning(f"获取文件列表失败 (parentFileId: {parentFileId}, page: {page}): {json.dumps(response_data, ensure_ascii=False)}")
                     yield {"isFinish": False, "message": f"获取文件列表失败：{response_data}"}
@@ -203,6 +360,41 @@ class Pan123:
             logger.error(f"listFiles 请求发生异常 (parentFileId: {parentFileId}): {e}", exc_info=True)
             yield {"isFinish": False, "message": f"获取文件列表请求发生异常: {e}"}
 
+    def listFolderPage(self, parentFileId, page, limit=100):
+        # 读取文件夹内的一页文件 (不递归), 按文件Id升序, 即最早上传的文件在前
+        body = {
+			"driveId":              "0",
+			"limit":                f"{limit}",
+			"next":                 "0",
+			"orderBy":              "file_id",
+			"orderDirection":       "asc",
+			"parentFileId":         parentFileId,
+			"trashed":              "false",
+			"SearchData":           "",
+			"Page":                 f"{page}",
+			"OnlyLookAbnormalFile": "0",
+			"event":                "homeListFile",
+			"operateType":          "4",
+			"inDirectSpace":        "false",
+		}
+        try:
+            response_data = self._request(
+                "GET", "FileList",
+                headers = self.headers,
+                params = body
+            )
+            if response_data.get("code") == 0:
+                response_data = response_data.get("data")
+                # 返回 {"InfoList": [...], "isLastPage": bool}
+                isLastPage = (response_data.get("Next") == "-1") or (len(response_data.get("InfoList")) < limit)
+                return {"isFinish": True, "message": {"InfoList": response_data.get("InfoList"), "isLastPage": isLastPage}}
+            else:
+                logger.warning(f"获取文件列表失败 (parentFileId: {parentFileId}, page: {page}): {json.dumps(response_data, ensure_ascii=False)}")
+                return {"isFinish": False, "message": f"获取文件列表失败：{response_data}"}
+        except Exception as e:
+            logger.error(f"获取文件列表请求发生异常 (parentFileId: {parentFileId}, page: {page}): {e}", exc_info=True)
+            return {"isFinish": False, "message": f"获取文件列表请求发生异常: {e}"}
+
     def exportFiles(self, parentFileId):
         # 读取文件夹
         yield {"isFinish": None, "message": f"读取文件夹中..."}
@@ -252,11 +444,11 @@ class Pan123:
             # "RequestSource": None,
         }
         try:
-            response_data = requests.post(
-                url = self.getActionUrl("Mkdir"),
+            response_data = self._request(
+                "POST", "Mkdir",
                 headers = self.headers,
                 json = body
-            ).json()
+            )
             if response_data.get("code") == 0:
                 if raw_data:
                     return {"isFinish": True, "message": response_data.get("data")}
@@ -266,10 +458,10 @@ class Pan123:
                 return {"isFinish": True, "message": fileId}
             else:
                 logger.error(f"创建文件夹失败 (parentFileId: {parentFileId}, folderName: {folderName}): {json.dumps(response_data, ensure_ascii=False)}")
-                return {"isFinish": False, "message": f"创建文件夹失败：{response_data}"}
+                return {"isFinish": False, "message": f"创建文件夹失败：{response_data}", "errorType": self._getErrorType(response_data)}
         except Exception as e:
             logger.error(f"创建文件夹请求发生异常 (parentFileId: {parentFileId}, folderName: {folderName}): {e}", exc_info=True)
-            return {"isFinish": False, "message": f"创建文件夹请求发生异常: {e}"}
+            return {"isFinish": False, "message": f"创建文件夹请求发生异常: {e}", "errorType": "upstream"}
     
     def uploadFile(self, etag, fileName, parentFileId, size, raw_data=False):
         body = {
@@ -283,11 +475,11 @@ class Pan123:
             "duplicate": 2, # 2->覆盖 1->重命名 0->默认
         }
         try:
-            response_data = requests.post(
-                url = self.getActionUrl("UploadRequest"),
+            response_data = self._request(
+                "POST", "UploadRequest",
                 headers = self.headers,
                 json = body
-            ).json()
+            )
             if response_data.get("code") == 0:
                 fileId = response_data.get("data").get("Info").get("FileId")
                 logger.debug(f"上传文件成功: {fileName}, fileId: {fileId}, parentFileId: {parentFileId}")
@@ -298,10 +490,11 @@ class Pan123:
                     return {"isFinish": True, "message": fileId}
             else:
                 logger.error(f"上传文件失败 (parentFileId: {parentFileId}, fileName: {fileName}): {json.dumps(response_data, ensure_ascii=False)}")
-                return {"isFinish": False, "message": f"上传文件失败：{response_data}"}
+                errorType = "folderMissing" if self._isFolderMissing(response_data) else self._getErrorType(response_data)
+                return {"isFinish": False, "message": f"上传文件失败：{response_data}", "errorType": errorType}
         except Exception as e:
             logger.error(f"上传文件请求发生异常 (parentFileId: {parentFileId}, fileName: {fileName}): {e}", exc_info=True)
-            return {"isFinish": False, "message": f"上传文件请求发生异常: {e}"}
+            return {"isFinish": False, "message": f"上传文件请求发生异常: {e}", "errorType": "upstream"}
     
     def deleteFile(self, fileList, clearTrash=False):
         trash_body = {
@@ -321,22 +514,22 @@ class Pan123:
             "RequestSource": None
             }
         try:
-            response_data = requests.post(
-                url = self.getActionUrl("Trash"),
+            response_data = self._request(
+                "POST", "Trash",
                 headers = self.headers,
                 json = trash_body
-            ).json()
+            )
             if response_data.get("code") == 0:
                 logger.debug(f"删除文件成功: {fileList}")
                 if not clearTrash:
                     return {"isFinish": True, "message": "删除文件成功"}
                 else:
                     # 彻底删除文件（删除回收站里的文件）
-                    response_data = requests.post(
-                        url = self.getActionUrl("TrashDelete"),
+                    response_data = self._request(
+                        "POST", "TrashDelete",
                         headers = self.headers,
                         json = delete_body
-                    ).json()
+                    )
                     if response_data.get("code") == 7301:
                         logger.debug(f"彻底删除文件成功: {fileList}")
                         return {"isFinish": True, "message": "彻底删除文件成功"}
@@ -363,20 +556,20 @@ class Pan123:
         "size": size
         }
         try:
-            response_data = requests.post(
-                url = self.getActionUrl("DownloadInfo"),
+            response_data = self._request(
+                "POST", "DownloadInfo",
                 headers = self.headers,
                 json = body
-            ).json()
+            )
             if response_data.get("code") == 0:
                 logger.debug(f"获取文件下载链接成功: {response_data}")
                 return {"isFinish": True, "message": response_data.get("data").get("DownloadUrl")}
             else:
                 logger.error(f"获取文件下载链接失败: {json.dumps(response_data, ensure_ascii=False)}")
-                return {"isFinish": False, "message": f"获取文件下载链接失败：{response_data}"}
+                return {"isFinish": False, "message": f"获取文件下载链接失败：{response_data}", "errorType": self._getErrorType(response_data)}
         except Exception as e:
             logger.error(f"获取文件下载链接请求发生异常: {e}", exc_info=True)
-            return {"isFinish": False, "message": f"获取文件下载链接请求发生异常: {e}"}
+            return {"isFinish": False, "message": f"获取文件下载链接请求发生异常: {e}", "errorType": "upstream"}
         
 
     def importFiles(self, base64Data, rootFolderName, filterIds = []):
@@ -536,12 +729,11 @@ class Pan123:
                 body.update({"Page": f"{page}"})
                 logger.debug(f"listShare: 正在获取第 {page} 页, parentFileId: {parentFileId}, shareKey: {shareKey}")
                 # 发送请求
-                time.sleep(self.sleepTime())
-                response_data = requests.get(
-                    url = self.getActionUrl("ShareList"),
+                response_data = self._request(
+                    "GET", "ShareList",
                     headers = self.headers,
                     params = body
-                ).json()
+                )
                 if response_data.get("code") == 0:
                     response_data = response_data.get("data")
                     # 把文件列表添加到ALL_FILES
@@ -550,10 +742,7 @@ class Pan123:
                     if (response_data.get("Next") == "-1") or (len(response_data.get("InfoList")) == 0):
                         logger.debug(f"listShare: 已是最后一页 (parentFileId: {parentFileId}, page: {page}, shareKey: {shareKey})")
                         break
-                    # 否则进入下一页 (等待 self.sleepTime 秒, 防止被封)
-                    else:
-                        logger.debug(f"listShare: 等待 {self.sleepTime()} 秒后进入下一页 (parentFileId: {parentFileId}, page: {page}, shareKey: {shareKey})")
-                        time.sleep(self.sleepTime())
+                    # 否则进入下一页 (self._request 会按限速等待, 防止被封)
                 else:
                     logger.warning(f"listShare 获取文件列表失败 (parentFileId: {parentFileId}, page: {page}, shareKey: {shareKey}): {json.dumps(response_data, ensure_ascii=False)}")
                     yield {"isFinish": False, "message": f"获取文件列表失败：{response_data}"}
@@ -212,12 +212,29 @@ class Pan123Database:
         
         return results, is_end_page
 
+    def iterData(self, visibleFlag: bool = True, batchSize: int = 5000):
+        # 使用独立游标一次性流式读取全部数据, 避免 listData 分页时的 COUNT(*) 和逐条查询
+        # 逐条返回 (codeHash, rootFolderName, timeStamp), 顺序与 listData 一致 (按 timeStamp 降序)
+        # 不读取 shareCode, 需要时再通过 getDataByHash 按主键读取
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT codeHash, rootFolderName, timeStamp FROM PAN123DATABASE WHERE visibleFlag=? ORDER BY timeStamp DESC",
+                (visibleFlag,)
+            )
+            while True:
+                rows = cursor.fetchmany(batchSize)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
     # 另一种方法: 同时进行 MATCH 搜索和 LIKE 搜索，但是这样速度很慢，暂时注释掉
-    def searchDataByName(self, search_keyword: str, page: int = 1, visible_flag: bool = True):
+    def searchDataByName(self, search_keyword: str, page: int = 1, visible_flag: bool = True, limit: int = 100):
         # 返回 [(codeHash, rootFolderName, timeStamp), ...], is_end_page
         if page < 1:
             page = 1
-        limit = 100
         offset = (page - 1) * limit
         
         # 为 rootFolderName 的 LIKE 查询准备搜索模式，例如: %keyword%
@@ -0,0 +1,90 @@
+"""
+路径查找基准测试: 在一个包含大量文件的合成分享目录中，对比逐个遍历 children 和使用 children_index 查找子节点的耗时。
+
+用法（在项目根目录运行）:
+    python benchmarks/children_index.py [--files 5000] [--paths 100] [--rounds 20]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import FileNode, TYPE_FILE, TYPE_DIRECTORY
+
+def build_wide_share(file_count: int) -> FileNode:
+    """
+    构建合成分享: 分享根目录 / 一个文件夹 / file_count 个文件
+    """
+    share_root = FileNode(id=0, parent_id=-1, name="share", type=TYPE_DIRECTORY, size=0, etag="", abs_path_str="share")
+    folder = FileNode(id=1, parent_id=0, name="Season 01", type=TYPE_DIRECTORY, size=0, etag="", abs_path_str="Season 01", parent=share_root)
+    share_root.children.append(folder)
+    for number in range(file_count):
+        folder.children.append(FileNode(
+            id=number + 2,
+            parent_id=1,
+            name=f"Episode {number:05d}.mkv",
+            type=TYPE_FILE,
+            size=1024,
+            etag=f"{number:032x}",
+            abs_path_str=f"Season 01/Episode {number:05d}.mkv",
+            parent=folder
+        ))
+    share_root.build_children_index()
+    folder.build_children_index()
+    return share_root
+
+def find_linear(share_root: FileNode, parts):
+    # 建立索引前 get_node_by_path 的查找方式
+    current_node = share_root
+    for part in parts:
+        found_child = None
+        for child in current_node.children:
+            if child.name == part:
+                found_child = child
+                break
+        if found_child is None:
+            return None
+        current_node = found_child
+    return current_node
+
+def find_indexed(share_root: FileNode, parts):
+    current_node = share_root
+    for part in parts:
+        current_node = current_node.get_child(part)
+        if current_node is None:
+            return None
+    return current_node
+
+def measure(find, share_root: FileNode, paths, rounds: int) -> float:
+    """
+    返回每次查找的平均耗时（微秒）
+    """
+    time_start = time.perf_counter()
+    for _ in range(rounds):
+        for parts in paths:
+            if find(share_root, parts) is None:
+                raise RuntimeError(f"未找到 {'/'.join(parts)}")
+    return (time.perf_counter() - time_start) / (rounds * len(paths)) * 1_000_000
+
+def main():
+    parser = argparse.ArgumentParser(description="对比逐个遍历和 children_index 查找子节点的耗时")
+    parser.add_argument("--files", type=int, default=5000, help="文件夹中的文件数")
+    parser.add_argument("--paths", type=int, default=100, help="随机选取的不同文件路径数")
+    parser.add_argument("--rounds", type=int, default=20, help="每条路径查找的轮数")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    args = parser.parse_args()
+
+    share_root = build_wide_share(args.files)
+    folder = share_root.children[0]
+    random.seed(args.seed)
+    paths = [(folder.name, child.name) for child in random.sample(folder.children, min(args.paths, args.files))]
+
+    print(f"合成分享: 1 个文件夹, {args.files} 个文件; {len(paths)} 条不同路径 x {args.rounds} 轮")
+    print(f"  逐个遍历:       {measure(find_linear, share_root, paths, args.rounds):8.2f} us/次")
+    print(f"  children_index: {measure(find_indexed, share_root, paths, args.rounds):8.2f} us/次")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import sqlite3
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from typing import Dict, List, Optional, Tuple
+
+class CacheStore:
+    """
+    下载链接缓存、缓存文件夹信息的本地持久化（SQLite），重启后可以直接使用。
+    读取只在启动时进行；写入放入队列，由后台线程批量写入，不阻塞获取下载链接。
+    """
+    def __init__(self, dbpath):
+        # 确保数据库目录存在
+        db_dir = os.path.dirname(dbpath)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+        self.dbpath = dbpath
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+
+        # URL_CACHE (
+        #   etag TEXT, size INTEGER, -- 文件的 etag 和大小
+        #   url TEXT,                -- 最终下载链接
+        #   expires REAL             -- 过期时间 (Unix 时间)
+        # )
+        # CACHE_FOLDER (
+        #   username TEXT PRIMARY KEY, -- 123云盘账号
+        #   info TEXT                  -- 缓存文件夹信息 (JSON)
+        # )
+        # CACHE_FOLDER_FILES (
+        #   username TEXT, etag TEXT, -- 123云盘账号, 文件的 etag (小写)
+        #   info TEXT                 -- 缓存文件夹中该文件的信息 (JSON, 含 FileId、S3KeyFlag 等)
+        # )
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS URL_CACHE (
+                etag TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (etag, size)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS CACHE_FOLDER (
+                username TEXT PRIMARY KEY,
+                info TEXT NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS CACHE_FOLDER_FILES (
+                username TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                info TEXT NOT NULL,
+                PRIMARY KEY (username, etag)
+            )
+        """)
+        # 启动时删除已过期的链接
+        self.conn.execute("DELETE FROM URL_CACHE WHERE expires <= ?", (time.time(),))
+        self.conn.commit()
+
+        # 待写入的操作 (SQL, 参数)，None 表示停止
+        self._queue: "queue.Queue[Optional[Tuple[str, tuple]]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self.conn.execute(*item)
+                # 把已排队的操作一起写入，再统一提交
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self.conn.commit()
+                        return
+                    self.conn.execute(*item)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"写入 {self.dbpath} 失败: {e}")
+
+    def close(self):
+        """
+        写完队列中的操作后停止（程序退出时自动调用）
+        """
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+    # --- 下载链接 ---
+    def load_urls(self) -> List[Tuple[str, int, str, float]]:
+        """
+        读取未过期的下载链接 [(etag, size, url, expires), ...]，按过期时间升序
+        """
+        return self.conn.execute(
+            "SELECT etag, size, url, expires FROM URL_CACHE WHERE expires > ? ORDER BY expires",
+            (time.time(),)
+        ).fetchall()
+
+    def put_url(self, etag: str, size: int, url: str, expires: float):
+        self._queue.put(("INSERT OR REPLACE INTO URL_CACHE (etag, size, url, expires) VALUES (?, ?, ?, ?)", (etag, size, url, expires)))
+
+    def delete_url(self, etag: str, size: int):
+        self._queue.put(("DELETE FROM URL_CACHE WHERE etag=? AND size=?", (etag, size)))
+
+    # --- 缓存文件夹 ---
+    def load_cache_folder(self, username: str) -> Tuple[Optional[dict], Dict[str, dict]]:
+        """
+        读取账号的缓存文件夹信息和其中的文件 (缓存文件夹信息, {etag: 文件信息})
+        """
+        row = self.conn.execute("SELECT info FROM CACHE_FOLDER WHERE username=?", (username,)).fetchone()
+        if row is None:
+            return None, {}
+        files = {
+            etag: json.loads(info)
+            for etag, info in self.conn.execute("SELECT etag, info FROM CACHE_FOLDER_FILES WHERE username=?", (username,))
+        }
+        return json.loads(row[0]), files
+
+    def put_cache_folder(self, username: str, info: Optional[dict]):
+        """
+        记录缓存文件夹信息，info 为 None 表示缓存文件夹已失效（同时清空其中的文件记录）
+        """
+        if info is None:
+            self._queue.put(("DELETE FROM CACHE_FOLDER WHERE username=?", (username,)))
+            self._queue.put(("DELETE FROM CACHE_FOLDER_FILES WHERE username=?", (username,)))
+        else:
+            self._queue.put(("INSERT OR REPLACE INTO CACHE_FOLDER (username, info) VALUES (?, ?)", (username, json.dumps(info, ensure_ascii=False))))
+
+    def put_file(self, username: str, etag: str, info: dict):
+        self._queue.put(("INSERT OR REPLACE INTO CACHE_FOLDER_FILES (username, etag, info) VALUES (?, ?, ?)", (username, etag, json.dumps(info, ensure_ascii=False))))
+
+    def delete_file(self, username: str, etag: str):
+        self._queue.put(("DELETE FROM CACHE_FOLDER_FILES WHERE username=? AND etag=?", (username, etag)))
+
+    def replace_files(self, username: str, files: Dict[str, dict]):
+        """
+        以缓存文件夹中实际的文件替换全部记录（清理缓存文件夹后调用）
+        """
+        self._queue.put(("DELETE FROM CACHE_FOLDER_FILES WHERE username=?", (username,)))
+        for etag, info in files.items():
+            self.put_file(username, etag, info)
@@ -1,6 +1,17 @@
+import os
+import re
 import json
+import datetime
+import mmap
 import base64
+import struct
+import array
+import email.utils
+import zlib
 import yaml
+import threading
+import time
+from collections import OrderedDict
 from typing import Dict, Optional, List, Tuple
 
 from models import FileNode, TYPE_DIRECTORY
@@ -12,66 +23,476 @@ with open("settings.yaml", "r", encoding="utf-8") as f:
 
 # 决定是否分桶
 SPLIT_FOLDER = settings_data.get('SPLIT_FOLDER')
+# 分桶后每个文件夹内最多显示的条目数，超出时自动再向下拆分一层
+# 按哈希分桶时每层至少有 16 个前缀，根目录还可能有搜索目录，因此最小为 17
+SPLIT_FOLDER_MAX_ENTRIES = max(settings_data.get('SPLIT_FOLDER_MAX_ENTRIES', 1000), 17)
+# 分桶依据: "hash" 按 codeHash 前缀分桶（与旧版路径兼容），"name" 按名称排序后分段（便于按字母浏览）
+SPLIT_FOLDER_KEY = settings_data.get('SPLIT_FOLDER_KEY', "hash")
+# 分桶目录节点的起始 ID
+BUCKET_NODE_ID_START = 200000
 
-# 初始化缓存结构
-MEMORY_CACHE_BY_NAME: Dict[str, Tuple[str, str]] = {}
-MEMORY_CACHE_BY_BUCKET: Dict[str, List[str]] = {}
-MEMORY_CACHE_NAMES_LIST: List[str] = []  # 平铺模式下的全部 rootFolderName
-HASH_BUCKET_NAMES: List[str] = [f"{i:02x}" for i in range(256)]
+# 是否在数据库旁生成索引文件，用于加快启动速度
+VFS_INDEX_FILE = settings_data.get('VFS_INDEX_FILE', True)
+# 索引文件格式: 文件头 + 校验键(数据库大小, 修改时间, 表结构版本, 条目数, 名称区长度) + codeHash 区 + 时间区 + 名称区
+INDEX_FILE_MAGIC = b"P123VFS2"
+INDEX_FILE_HEADER = struct.Struct("<QqqQQ")
 
-def load_data_into_memory(db: Pan123Database):
+# 检查数据库文件是否被替换的间隔（秒），0 表示不检查
+DATABASE_RELOAD_INTERVAL = settings_data.get('DATABASE_RELOAD_INTERVAL', 60)
+# 重建索引后，等待多久（秒）再关闭旧索引的数据库连接，让仍在使用旧索引的请求先完成
+OLD_INDEX_CLOSE_DELAY = 60
+# 数据库中 timeStamp 列的时区 (GMT+8: 北京时间)
+DATABASE_TIMEZONE = datetime.timezone(datetime.timedelta(hours=8))
+
+# 搜索目录名称，访问 /搜索目录名称/关键词/ 即可列出匹配的分享，留空表示不启用
+SEARCH_FOLDER_NAME = settings_data.get('SEARCH_FOLDER_NAME', "search")
+# 每次搜索最多返回的分享数
+SEARCH_MAX_RESULTS = settings_data.get('SEARCH_MAX_RESULTS', 200)
+# 搜索结果缓存时间（秒）
+SEARCH_CACHE_TTL = settings_data.get('SEARCH_CACHE_TTL', 600)
+# 最多缓存多少个不同关键词的搜索结果
+SEARCH_CACHE_SIZE = 256
+# 搜索目录及搜索结果目录的节点 ID
+SEARCH_NODE_ID = 100000
+SEARCH_RESULT_NODE_ID = 100001
+
+# 目录结构及搜索结果相关设置的指纹，加入索引版本号中，修改这些设置并重启后 PROPFIND 的 ETag 也会随之变化
+LAYOUT_FINGERPRINT = zlib.crc32(repr((SPLIT_FOLDER, SPLIT_FOLDER_MAX_ENTRIES, SPLIT_FOLDER_KEY, SEARCH_FOLDER_NAME, SEARCH_MAX_RESULTS)).encode("utf-8"))
+
+# 分享目录树缓存上限（按节点总数计算）
+SHARE_TREE_CACHE_NODES = settings_data.get('SHARE_TREE_CACHE_NODES', 50000)
+
+class LookupWouldBlock(Exception):
     """
-    数据加载和分组（分桶/平铺）
+    以非阻塞方式查找路径时，需要查询数据库或解码 shareCode（调用方应改为在线程池中查找）
     """
-    print("开始从数据库加载所有公开分享数据到内存...")
-    page = 1
-    all_shares = []
-
-    while True:
-        print(f"正在读取分享数据 (批次 {page}) ...")
-        shares_page, is_end_page = db.listData(visibleFlag=True, page=page, limit=10000)
-        all_shares.extend(shares_page)
-        if is_end_page:
-            break
-        page += 1
-    
-    print(f"共获取 {len(all_shares)} 条分享记录，构建缓存 ...")
-    # 清空所有缓存结构
-    MEMORY_CACHE_BY_NAME.clear()
-    MEMORY_CACHE_BY_BUCKET.clear()
-    MEMORY_CACHE_NAMES_LIST.clear()
-
-    # 建桶
-    for bucket_name in HASH_BUCKET_NAMES:
-        MEMORY_CACHE_BY_BUCKET[bucket_name] = []
-    
-    temp_name_list = []
-    for codeHash, rootFolderName, _ in all_shares:
-        data = db.getDataByHash(codeHash)
-        if data:
-            _rootFolderName, shareCode, _visibleFlag = data[0]
-            MEMORY_CACHE_BY_NAME[rootFolderName] = (shareCode, codeHash)
-            # 平铺模式要用的全量name
-            temp_name_list.append(rootFolderName)
-            # 桶模式用的哈希前缀
-            bucket = codeHash[:2]
-            MEMORY_CACHE_BY_BUCKET[bucket].append(rootFolderName)
+
+class ShareTreeCache:
+    """
+    已解析分享目录树的 LRU 缓存，以 (codeHash, 分享名称, 修改时间) 为键，按节点总数限制容量。
+    数据库更新后分享改名或时间变化时，键随之变化，不会返回旧名称、旧时间的目录树
+    """
+    def __init__(self, max_nodes: int):
+        self.max_nodes = max_nodes
+        self.total_nodes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Tuple[str, str, str], Tuple[FileNode, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str, str], count_miss: bool = True) -> Optional[FileNode]:
+        """
+        count_miss 为 False 时未命中不计入统计（调用方随后会在线程池中重新查找，由那次查找计入）
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Tuple[str, str, str], share_root_node: FileNode, node_count: int):
+        with self._lock:
+            if key in self._items:
+                self.total_nodes -= self._items.pop(key)[1]
+            self._items[key] = (share_root_node, node_count)
+            self.total_nodes += node_count
+            # 超出容量时淘汰最久未使用的分享（至少保留刚放入的这一个）
+            while self.total_nodes > self.max_nodes and len(self._items) > 1:
+                _, (_, evicted_count) = self._items.popitem(last=False)
+                self.total_nodes -= evicted_count
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_nodes = 0
+
+    def retain(self, keys: set):
+        """
+        只保留键仍然存在的分享（数据库热更新后调用）
+        """
+        with self._lock:
+            for key in [key for key in self._items if key not in keys]:
+                self.total_nodes -= self._items.pop(key)[1]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "shares": len(self._items),
+                "nodes": self.total_nodes,
+                "max_nodes": self.max_nodes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+def _share_tree_key(share_node: FileNode) -> Tuple[str, str, str]:
+    """
+    分享在目录树缓存中的键: (codeHash, 分享名称, 修改时间)
+    """
+    return share_node.etag, share_node.name, share_node.last_modified
+
+def _get_rss_mb() -> Optional[float]:
+    """
+    读取当前进程的常驻内存 (MB)，仅支持 Linux，其他平台返回 None
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def _get_index_file_key(db: Pan123Database, db_path: str) -> Tuple[int, int, int]:
+    """
+    索引文件的校验键: (数据库文件大小, 修改时间, 表结构版本)，任一变化都需要重建索引文件
+    """
+    stat = os.stat(db_path)
+    db.database.execute("PRAGMA schema_version")
+    schema_version = db.database.fetchone()[0]
+    return stat.st_size, stat.st_mtime_ns, schema_version
+
+def _parse_database_time(timeStamp: Optional[str], default: int) -> int:
+    """
+    把数据库中的 timeStamp (GMT+8, 形如 2024-01-01 12:00:00) 转换为 Unix 时间，无法解析时返回 default
+    """
+    if not timeStamp:
+        return default
+    try:
+        return int(datetime.datetime.fromisoformat(timeStamp).replace(tzinfo=DATABASE_TIMEZONE).timestamp())
+    except (TypeError, ValueError):
+        return default
+
+def _read_index_file(index_path: str, key: Tuple[int, int, int]) -> Optional[Tuple[List[str], List[str], List[int]]]:
+    """
+    通过 mmap 读取索引文件，返回 (按名称排序的 rootFolderName 列表, 对应的 codeHash 列表, 对应的时间戳列表)。
+    文件不存在、格式不符或校验键不一致时返回 None。
+    """
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(INDEX_FILE_MAGIC)] != INDEX_FILE_MAGIC:
+                return None
+            offset = len(INDEX_FILE_MAGIC)
+            db_size, db_mtime_ns, schema_version, count, names_length = INDEX_FILE_HEADER.unpack_from(mm, offset)
+            if (db_size, db_mtime_ns, schema_version) != key:
+                return None
+            offset += INDEX_FILE_HEADER.size
+            # codeHash 以 32 字节原始摘要连续存放
+            hashes_blob = mm[offset:offset + count * 32]
+            offset += count * 32
+            # 时间戳以 8 字节整数（Unix 时间，秒）连续存放
+            times = array.array("q")
+            times.frombytes(mm[offset:offset + count * 8])
+            offset += count * 8
+            names_blob = mm[offset:offset + names_length]
+        names = names_blob.decode("utf-8").split("\0") if count else []
+        hashes = [hashes_blob[i:i + 32].hex() for i in range(0, count * 32, 32)]
+        if len(names) != count or len(hashes) != count or len(times) != count:
+            return None
+        return names, hashes, times.tolist()
+    except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+        print(f"读取索引文件失败，将从数据库重建: {e}")
+        return None
+
+def _write_index_file(index_path: str, key: Tuple[int, int, int], names: List[str], hashes: List[str], times: List[int]):
+    """
+    写入索引文件（先写临时文件再替换，避免留下不完整的文件）
+    """
+    names_blob = "\0".join(names).encode("utf-8")
+    tmp_path = f"{index_path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_FILE_MAGIC)
+            f.write(INDEX_FILE_HEADER.pack(*key, len(names), len(names_blob)))
+            f.write(b"".join(bytes.fromhex(codeHash) for codeHash in hashes))
+            f.write(array.array("q", times).tobytes())
+            f.write(names_blob)
+        os.replace(tmp_path, index_path)
+        print(f"索引文件已写入: {index_path}")
+    except OSError as e:
+        print(f"写入索引文件失败（不影响使用）: {e}")
+
+class VfsIndex:
+    """
+    某一版本数据库对应的全部只读索引（名称索引、分桶、根目录树）。
+    数据库热更新时整体替换，请求只会看到完整的旧索引或完整的新索引。
+    """
+    def __init__(self, db: Pan123Database, key: Tuple[int, int, int], names: List[str], hashes: List[str], times: List[int]):
+        # 该版本数据库的连接，用于按需读取 shareCode
+        self.db = db
+        # 数据库连接共用一个游标，不能被多个线程同时使用（搜索在线程池中执行）
+        self.db_lock = threading.Lock()
+        # (数据库大小, 修改时间, 表结构版本)
+        self.key = key
+        self.version = "-".join(f"{value:x}" for value in (*key, LAYOUT_FINGERPRINT))
+        # 已格式化的时间字符串 {Unix 时间: HTTP 日期}，相同时间共用同一个字符串
+        self._formatted_times: Dict[int, str] = {}
+        # 数据库文件的修改时间，用于搜索目录等没有对应分享的节点
+        self.database_time = key[1] // 1_000_000_000
+        self.last_modified = self._format_time(self.database_time)
+        # {rootFolderName: codeHash}，shareCode 在首次进入分享时再按主键从数据库读取
+        self.name_to_hash: Dict[str, str] = dict(zip(names, hashes))
+        # {rootFolderName: 分享加入数据库的时间 (Unix 时间)}
+        self.name_to_time: Dict[str, int] = dict(zip(names, times))
+        # 全部 rootFolderName（已按名称排序）
+        self.names = names
+        self._next_bucket_id = BUCKET_NODE_ID_START
+        # 搜索目录节点（未启用搜索时为 None）
+        self.search_node: Optional[FileNode] = None
+        time_start = time.perf_counter()
+        self.root = self._build_root_and_buckets()
+        print(f"目录结构构建完成 (耗时 {time.perf_counter() - time_start:.2f} 秒)。")
+
+    def close(self):
+        """
+        关闭该版本数据库的连接（索引被替换后调用）
+        """
+        with self.db_lock:
+            self.db.conn.close()
+
+    def _format_time(self, timestamp: int) -> str:
+        """
+        格式化为 WebDAV getlastmodified / HTTP Last-Modified 使用的 RFC 1123 日期
+        """
+        formatted = self._formatted_times.get(timestamp)
+        if formatted is None:
+            formatted = email.utils.formatdate(timestamp, usegmt=True)
+            self._formatted_times[timestamp] = formatted
+        return formatted
+
+    def _latest_time(self, names: List[str]) -> str:
+        """
+        目录的修改时间取其下最新加入的分享的时间
+        """
+        if not names:
+            return self.last_modified
+        return self._format_time(max(self.name_to_time[name] for name in names))
+
+    def _build_root_and_buckets(self) -> FileNode:
+        """
+        一次性构建根目录和所有分桶目录（含其下的分享目录节点）。
+        构建完成后只读，所有请求共享同一棵树，不再在请求中修改。
+        """
+        root = FileNode(id=-1, parent_id=-2, name="ROOT", type=TYPE_DIRECTORY, size=0, etag="", abs_path_str="/")
+        root.last_modified = self._latest_time(self.names)
+        if not SPLIT_FOLDER:
+            # 平铺
+            self._fill_share_nodes(root, self.names)
+        elif SPLIT_FOLDER_KEY == "name":
+            # 按名称分段
+            # 根目录中需要给搜索目录留出位置
+            self._split_by_name(root, self.names, SPLIT_FOLDER_MAX_ENTRIES - 1 if SEARCH_FOLDER_NAME else SPLIT_FOLDER_MAX_ENTRIES)
         else:
-            print(f"警告：无法解析 codeHash 为 {codeHash} 的数据，已跳过")
+            # 按哈希前缀分桶，根目录始终拆分一层，保持 /xx/分享名 的旧路径不变
+            self._split_by_hash(root, self.names, prefix_length=0, force=True)
+        if SEARCH_FOLDER_NAME:
+            # 根目录中与搜索目录同名的条目无法访问（路径总是进入搜索目录），不再列出，只能通过搜索找到
+            conflicts = [child for child in root.children if child.name == SEARCH_FOLDER_NAME]
+            if conflicts:
+                print(f"警告：根目录中有 {len(conflicts)} 个条目与搜索目录 '{SEARCH_FOLDER_NAME}' 同名，已从根目录隐藏，可通过搜索访问")
+                root.children = [child for child in root.children if child.name != SEARCH_FOLDER_NAME]
+            # 搜索目录本身没有内容，需要在路径中继续输入关键词
+            self.search_node = FileNode(
+                id=SEARCH_NODE_ID,
+                parent_id=root.id,
+                name=SEARCH_FOLDER_NAME,
+                type=TYPE_DIRECTORY,
+                size=0,
+                etag="search",
+                abs_path_str=SEARCH_FOLDER_NAME,
+                parent=root,
+                last_modified=self.last_modified
+            )
+            root.children.append(self.search_node)
+        root.build_children_index()
+        return root
+
+    def search(self, keyword: str) -> FileNode:
+        """
+        通过 FTS 索引搜索分享，返回以关键词命名、以匹配分享为子节点的目录
+        """
+        result_node = FileNode(
+            id=SEARCH_RESULT_NODE_ID,
+            parent_id=SEARCH_NODE_ID,
+            name=keyword,
+            type=TYPE_DIRECTORY,
+            size=0,
+            etag=f"search_{keyword}",
+            abs_path_str=f"{SEARCH_FOLDER_NAME}/{keyword}",
+            parent=self.search_node,
+            last_modified=self.last_modified
+        )
+        # FTS5 的查询语法中标点有特殊含义，只保留文字、数字作为关键词
+        search_keyword = re.sub(r"[^\w\s]", " ", keyword).strip()
+        if not search_keyword:
+            return result_node
+        with self.db_lock:
+            results, _ = self.db.searchDataByName(search_keyword, page=1, visible_flag=True, limit=SEARCH_MAX_RESULTS)
+        for codeHash, rootFolderName, _timeStamp in results:
+            # 只列出当前索引中可以访问到的分享（重名时只保留索引中的那一个）
+            if self.name_to_hash.get(rootFolderName) == codeHash:
+                result_node.children.append(self._make_share_node(rootFolderName, result_node))
+        result_node.last_modified = self._latest_time([child.name for child in result_node.children])
+        result_node.build_children_index()
+        return result_node
+
+    def _make_bucket_node(self, name: str, parent: FileNode) -> FileNode:
+        bucket_path = name if parent.abs_path_str == "/" else f"{parent.abs_path_str}/{name}"
+        bucket_node = FileNode(
+            id=self._next_bucket_id,
+            parent_id=parent.id,
+            name=name,
+            type=TYPE_DIRECTORY,
+            size=0,
+            etag=f"bucket_{bucket_path}",
+            abs_path_str=bucket_path,
+            parent=parent
+        )
+        self._next_bucket_id += 1
+        parent.children.append(bucket_node)
+        return bucket_node
+
+    def _fill_share_nodes(self, parent: FileNode, names: List[str]):
+        for name in names:
+            parent.children.append(self._make_share_node(name, parent))
 
-    MEMORY_CACHE_NAMES_LIST.extend(sorted(temp_name_list))
-    for bucket_key in MEMORY_CACHE_BY_BUCKET:
-        MEMORY_CACHE_BY_BUCKET[bucket_key].sort()
-    print(f"内存缓存构建完成，总条目 {len(MEMORY_CACHE_BY_NAME)}.")
+    def _split_by_hash(self, parent: FileNode, names: List[str], prefix_length: int, force: bool = False):
+        """
+        条目数超过上限时，按 codeHash 的下一段前缀拆分（每层 2 位，上限不超过 256 时每层 1 位，
+        保证加上搜索目录后根目录也不超过上限）
+        """
+        if len(names) <= SPLIT_FOLDER_MAX_ENTRIES and not force:
+            self._fill_share_nodes(parent, names)
+            return
+        step = 2 if SPLIT_FOLDER_MAX_ENTRIES > 256 else 1
+        groups: Dict[str, List[str]] = {}
+        for name in names:
+            codeHash = self.name_to_hash[name]
+            groups.setdefault(codeHash[prefix_length:prefix_length + step], []).append(name)
+        for segment in sorted(groups):
+            bucket_node = self._make_bucket_node(segment, parent)
+            bucket_node.last_modified = self._latest_time(groups[segment])
+            self._split_by_hash(bucket_node, groups[segment], prefix_length + step)
+            bucket_node.build_children_index()
+
+    def _split_by_name(self, parent: FileNode, names: List[str], max_entries: int = SPLIT_FOLDER_MAX_ENTRIES):
+        """
+        条目数超过上限时，把已排序的名称按顺序切分成若干段，每段一个文件夹，名称形如 "001 甲 ~ 乙"
+        max_entries 为本层的条目数上限，下层始终使用 SPLIT_FOLDER_MAX_ENTRIES
+        """
+        if len(names) <= max_entries:
+            self._fill_share_nodes(parent, names)
+            return
+        # 每段的大小取上限的整数次幂，保证本层的段数也不超过上限
+        chunk_size = SPLIT_FOLDER_MAX_ENTRIES
+        while (len(names) + chunk_size - 1) // chunk_size > max_entries:
+            chunk_size *= SPLIT_FOLDER_MAX_ENTRIES
+        for number, start in enumerate(range(0, len(names), chunk_size), start=1):
+            chunk = names[start:start + chunk_size]
+            label = f"{number:03d} {chunk[0][:8].strip()} ~ {chunk[-1][:8].strip()}"
+            bucket_node = self._make_bucket_node(label, parent)
+            bucket_node.last_modified = self._latest_time(chunk)
+            self._split_by_name(bucket_node, chunk)
+            bucket_node.build_children_index()
+
+    def share_tree_keys(self) -> set:
+        """
+        当前索引中所有分享在目录树缓存中的键
+        """
+        return {(codeHash, name, self._format_time(self.name_to_time[name])) for name, codeHash in self.name_to_hash.items()}
+
+    def is_share_node(self, node: FileNode) -> bool:
+        """
+        判断分桶目录树中的节点是否为分享（而不是分桶目录）
+        """
+        return self.name_to_hash.get(node.name) == node.etag
+
+    def _make_share_node(self, name: str, parent: FileNode) -> FileNode:
+        """
+        构建分享在目录列表中的节点（不含分享内部内容）
+        """
+        codeHash = self.name_to_hash[name]
+        return FileNode(
+            id=int(codeHash[:8], 16),
+            parent_id=parent.id,
+            name=name,
+            type=TYPE_DIRECTORY,
+            size=0,
+            etag=codeHash,
+            abs_path_str=name,
+            parent=parent,
+            last_modified=self._format_time(self.name_to_time[name])
+        )
+
+def load_data_into_memory(db: Pan123Database, db_path: str) -> VfsIndex:
+    """
+    数据加载和分组（分桶/平铺）。
+    优先读取数据库旁的索引文件；索引文件无效时，单次流式读取数据库并重建索引文件。
+    返回构建完成的只读索引 VfsIndex。
+    """
+    print("开始从数据库加载所有公开分享数据到内存...")
+    rss_before = _get_rss_mb()
+    time_start = time.perf_counter()
+
+    index_data = None
+    key = _get_index_file_key(db, db_path)
+    if VFS_INDEX_FILE:
+        index_path = f"{db_path}.vfsindex"
+        index_data = _read_index_file(index_path, key)
+
+    if index_data is not None:
+        names, hashes, times = index_data
+        print(f"从索引文件读取 {len(names)} 条分享记录 (耗时 {time.perf_counter() - time_start:.2f} 秒)")
+    else:
+        name_to_share: Dict[str, Tuple[str, int]] = {}
+        default_time = key[1] // 1_000_000_000
+        for codeHash, rootFolderName, timeStamp in db.iterData(visibleFlag=True):
+            # 重名时保留最后读到的（最早的）分享
+            name_to_share[rootFolderName] = (codeHash, _parse_database_time(timeStamp, default_time))
+        names = sorted(name_to_share)
+        hashes = [name_to_share[name][0] for name in names]
+        times = [name_to_share[name][1] for name in names]
+        print(f"从数据库读取 {len(names)} 条分享记录 (耗时 {time.perf_counter() - time_start:.2f} 秒)")
+        if VFS_INDEX_FILE:
+            _write_index_file(index_path, key, names, hashes, times)
+    time_loaded = time.perf_counter()
+
+    index = VfsIndex(db, key, names, hashes, times)
+    print(f"内存缓存构建完成，总条目 {len(index.name_to_hash)} (耗时 {time.perf_counter() - time_loaded:.2f} 秒)。")
+    rss_after = _get_rss_mb()
+    if rss_before is not None and rss_after is not None:
+        print(f"进程内存占用: 加载前 {rss_before:.1f} MB, 加载后 {rss_after:.1f} MB")
+    return index
 
 class VirtualFileSystem:
     """
-    虚拟文件系统类，动态支持分桶和平铺两种根目录视图
+    虚拟文件系统类，支持分桶（按哈希前缀或名称自动分层）和平铺两种根目录视图
     """
     def __init__(self, db_path: str):
-        self.db = Pan123Database(dbpath=db_path)
-        load_data_into_memory(self.db)
-        self.root = FileNode(id=-1, parent_id=-2, name="ROOT", type=TYPE_DIRECTORY, size=0, etag="", abs_path_str="/")
+        self.db_path = db_path
+        self.tree_cache = ShareTreeCache(max_nodes=SHARE_TREE_CACHE_NODES)
+        self.index = load_data_into_memory(Pan123Database(dbpath=db_path), db_path)
+        # 搜索结果缓存: {(索引版本, 关键词): (过期时间, 搜索结果目录)}
+        self.search_cache: "OrderedDict[Tuple[str, str], Tuple[float, FileNode]]" = OrderedDict()
+        self._search_lock = threading.Lock()
+        # 热更新状态
+        self._reload_lock = threading.Lock()
+        self.reload_status = {
+            "version": self.index.version,
+            "shares": len(self.index.name_to_hash),
+            "reloading": False,
+            "last_reload_time": None,
+            "last_reload_seconds": None,
+            "last_error": None,
+        }
+        if DATABASE_RELOAD_INTERVAL:
+            threading.Thread(target=self._watch_database, daemon=True).start()
         print(f"虚拟文件系统已初始化，数据从内存读取。")
         print(f"请通过WebDAV客户端挂载：\n\n")
         print(f"链接（本机访问）: http://127.0.0.1:{settings_data.get('WEBDAV_PORT')}/")
@@ -81,15 +502,16 @@ class VirtualFileSystem:
         print(f"WebDAV 密码: {settings_data.get('WEBDAV_PASSWORD')}")
         
 
-    def _build_tree_from_share_code(self, share_code: str) -> List[FileNode]:
+    def _build_tree_from_share_code(self, share_code: str, last_modified: str) -> Tuple[List[FileNode], int]:
         """
-        解析shareCode（base64）为本地虚拟树形结构
+        解析shareCode（base64）为本地虚拟树形结构，返回 (顶层节点列表, 节点总数)。
+        分享内的所有节点都使用分享的修改时间 last_modified。
         """
         try:
             json_data = json.loads(base64.urlsafe_b64decode(share_code))
         except Exception as e:
             print(f"解析 shareCode 失败: {e}")
-            return []
+            return [], 0
         nodes: Dict[int, FileNode] = {}
         for item in json_data:
             node = FileNode(
@@ -99,7 +521,8 @@ class VirtualFileSystem:
                 type=item['Type'],
                 size=item['Size'],
                 etag=item['Etag'],
-                abs_path_str=item.get('AbsPath', '')
+                abs_path_str=item.get('AbsPath', ''),
+                last_modified=last_modified
             )
             nodes[item['FileId']] = node
         top_level_nodes = []
@@ -109,134 +532,180 @@ class VirtualFileSystem:
                 node.parent = nodes[node.parent_id]
             else:
                 top_level_nodes.append(node)
-        return top_level_nodes
+        # 为所有目录建立名称索引，路径查找时每一级只需一次字典查询
+        for node in nodes.values():
+            if node.type == TYPE_DIRECTORY:
+                node.build_children_index()
+        return top_level_nodes, len(nodes)
 
-    def get_node_by_path(self, path: str) -> Optional[FileNode]:
+    def reload(self) -> bool:
         """
-        路径匹配
+        重新读取数据库并构建新索引，完成后原子替换。构建期间旧索引继续提供服务。
+        同一时间只允许一个重建任务，已有任务在运行时直接返回 False。
         """
-        path = path.strip('/')
-        parts = path.split('/') if path else []
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        self.reload_status["reloading"] = True
+        time_start = time.perf_counter()
+        try:
+            print("开始重建索引...")
+            new_index = load_data_into_memory(Pan123Database(dbpath=self.db_path), self.db_path)
+            # codeHash 即 shareCode 的哈希，名称和时间也未变化的分享目录树可以直接沿用
+            self.tree_cache.retain(new_index.share_tree_keys())
+            old_index = self.index
+            self.index = new_index
+            timer = threading.Timer(OLD_INDEX_CLOSE_DELAY, old_index.close)
+            timer.daemon = True
+            timer.start()
+            self.reload_status.update({
+                "version": new_index.version,
+                "shares": len(new_index.name_to_hash),
+                "last_reload_time": int(time.time()),
+                "last_reload_seconds": round(time.perf_counter() - time_start, 3),
+                "last_error": None,
+            })
+            print(f"索引重建完成，共 {len(new_index.name_to_hash)} 条分享 (耗时 {time.perf_counter() - time_start:.2f} 秒)")
+            return True
+        except Exception as e:
+            print(f"索引重建失败，继续使用旧索引: {e}")
+            self.reload_status["last_error"] = str(e)
+            return False
+        finally:
+            self.reload_status["reloading"] = False
+            self._reload_lock.release()
 
-        # == 根目录 ==
-        if not parts:
-            self.root.children = []
-            if SPLIT_FOLDER:
-                # 256分桶
-                for i, bucket_name in enumerate(HASH_BUCKET_NAMES):
-                    bucket_node = FileNode(
-                        id=200000 + i,
-                        parent_id=self.root.id,
-                        name=bucket_name,
-                        type=TYPE_DIRECTORY,
-                        size=0,
-                        etag=f"bucket_{bucket_name}",
-                        abs_path_str=bucket_name,
-                        parent=self.root
-                    )
-                    self.root.children.append(bucket_node)
-            else:
-                # 平铺
-                for i, name in enumerate(MEMORY_CACHE_NAMES_LIST):
-                    _, codeHash = MEMORY_CACHE_BY_NAME.get(name, (None, None))
-                    share_node = FileNode(
-                        id=int(codeHash[:8], 16),
-                        parent_id=self.root.id,
-                        name=name,
-                        type=TYPE_DIRECTORY,
-                        size=0,
-                        etag=codeHash,
-                        abs_path_str=name,
-                        parent=self.root
-                    )
-                    self.root.children.append(share_node)
-            return self.root
-
-        # == 分桶下一级 ==
-        if SPLIT_FOLDER and len(parts) == 1 and parts[0] in HASH_BUCKET_NAMES:
-            bucket_name = parts[0]
-            bucket_node = FileNode(
-                id=200000 + HASH_BUCKET_NAMES.index(bucket_name),
-                parent_id=self.root.id,
-                name=bucket_name,
+    def reload_in_background(self) -> bool:
+        """
+        在后台线程中重建索引，已有任务在运行时返回 False
+        """
+        if self._reload_lock.locked():
+            return False
+        threading.Thread(target=self.reload, daemon=True).start()
+        return True
+
+    def _watch_database(self):
+        """
+        定期检查数据库文件，发现被替换且写入完成（连续两次检查一致）后自动重建索引
+        """
+        pending_stat = None
+        while True:
+            time.sleep(DATABASE_RELOAD_INTERVAL)
+            try:
+                stat = os.stat(self.db_path)
+            except OSError:
+                continue
+            current_stat = (stat.st_size, stat.st_mtime_ns)
+            if current_stat == self.index.key[:2]:
+                pending_stat = None
+                continue
+            if current_stat != pending_stat:
+                pending_stat = current_stat
+                continue
+            print("检测到数据库文件变化，开始后台重建索引...")
+            self.reload()
+            pending_stat = None
+
+    def _get_share_root(self, index: VfsIndex, share_node: FileNode, blocking: bool = True) -> Optional[FileNode]:
+        """
+        获取分享的完整目录树（优先从缓存读取，避免每次请求都重新读取、解码 shareCode）。
+        blocking 为 False 且不在缓存中时抛出 LookupWouldBlock
+        """
+        codeHash = share_node.etag
+        cache_key = _share_tree_key(share_node)
+        share_root_node = self.tree_cache.get(cache_key, count_miss=blocking)
+        if share_root_node is None:
+            if not blocking:
+                raise LookupWouldBlock(codeHash)
+            # 按主键从数据库读取 shareCode
+            with index.db_lock:
+                data = index.db.getDataByHash(codeHash)
+            if not data:
+                print(f"警告：无法读取 codeHash 为 {codeHash} 的分享数据")
+                return None
+            _rootFolderName, shareCode, _visibleFlag = data[0]
+            top_level_nodes, node_count = self._build_tree_from_share_code(shareCode, share_node.last_modified)
+            share_root_node = FileNode(
+                id=share_node.id,
+                parent_id=share_node.parent_id,
+                name=share_node.name,
                 type=TYPE_DIRECTORY,
                 size=0,
-                etag=f"bucket_{bucket_name}",
-                abs_path_str=bucket_name,
-                parent=self.root
+                etag=codeHash,
+                abs_path_str=share_node.name,
+                children=top_level_nodes,
+                last_modified=share_node.last_modified
             )
-            share_names = MEMORY_CACHE_BY_BUCKET.get(bucket_name, [])
-            bucket_node.children = []
-            for name in share_names:
-                _, codeHash = MEMORY_CACHE_BY_NAME.get(name, (None, None))
-                if codeHash:
-                    share_folder_node = FileNode(
-                        id=int(codeHash[:8], 16),
-                        parent_id=bucket_node.id,
-                        name=name,
-                        type=TYPE_DIRECTORY,
-                        size=0,
-                        etag=codeHash,
-                        abs_path_str=name,
-                        parent=bucket_node
-                    )
-                    bucket_node.children.append(share_folder_node)
-            return bucket_node
-
-        # == 进入具体分享 ==
-        # - 拆桶时路径是 /xx/分享名/...，平铺时路径是 /分享名/...
-        root_folder_name = None
-        parent_id = self.root.id
-        bucket_name = None
-        if SPLIT_FOLDER and len(parts) >= 2 and parts[0] in HASH_BUCKET_NAMES:
-            bucket_name = parts[0]
-            root_folder_name = parts[1]
-            parent_id = 200000 + HASH_BUCKET_NAMES.index(bucket_name)
-        elif not SPLIT_FOLDER and len(parts) >= 1:
-            root_folder_name = parts[0]
-        else:
-            return None
+            for node in top_level_nodes:
+                node.parent = share_root_node
+            share_root_node.build_children_index()
+            self.tree_cache.put(cache_key, share_root_node, node_count + 1)
+        return share_root_node
 
-        # 获取分享code
-        share_data = MEMORY_CACHE_BY_NAME.get(root_folder_name)
-        if not share_data:
-            print(f"未找到分享: {root_folder_name}")
-            return None
-        shareCode, codeHash = share_data
+    def _get_search_result(self, index: VfsIndex, keyword: str, blocking: bool = True) -> FileNode:
+        """
+        获取搜索结果目录（带过期时间的缓存，同一关键词在有效期内只查询一次数据库）。
+        blocking 为 False 且不在缓存中时抛出 LookupWouldBlock
+        """
+        cache_key = (index.version, keyword)
+        now = time.monotonic()
+        with self._search_lock:
+            cached = self.search_cache.get(cache_key)
+            if cached and cached[0] > now:
+                self.search_cache.move_to_end(cache_key)
+                return cached[1]
+        if not blocking:
+            raise LookupWouldBlock(keyword)
+        result_node = index.search(keyword)
+        print(f"搜索 '{keyword}': 找到 {len(result_node.children)} 个分享")
+        with self._search_lock:
+            self.search_cache[cache_key] = (now + SEARCH_CACHE_TTL, result_node)
+            self.search_cache.move_to_end(cache_key)
+            while len(self.search_cache) > SEARCH_CACHE_SIZE:
+                self.search_cache.popitem(last=False)
+        return result_node
+
+    def get_node_by_path(self, path: str, index: Optional[VfsIndex] = None, blocking: bool = True) -> Optional[FileNode]:
+        """
+        路径匹配。可传入调用方已取得的索引，保证同一请求内使用的是同一版本。
+        blocking 为 False 时（在事件循环中调用）不查询数据库、不解码 shareCode，需要时抛出 LookupWouldBlock
+        """
+        path = path.strip('/')
+        parts = path.split('/') if path else []
+        # 整个请求只使用同一版本的索引，热更新替换索引不会影响进行中的请求
+        if index is None:
+            index = self.index
+
+        # == 根目录 ==
+        if not parts:
+            return index.root
 
-        # 拆桶校验（安全健壮性）
-        if SPLIT_FOLDER and bucket_name:
-            if codeHash[:2] != bucket_name:
-                print(f"分桶模式校验失败：分享 {root_folder_name} codeHash {codeHash} 不属于 {bucket_name} 桶")
+        # == 分桶目录 ==
+        # - 拆桶时路径是 /xx/.../分享名/...，平铺时路径是 /分享名/...
+        current_node = index.root
+        depth = 0
+        # == 搜索目录 ==
+        # - 路径是 /search/关键词/分享名/...
+        if SEARCH_FOLDER_NAME and parts[0] == SEARCH_FOLDER_NAME:
+            if len(parts) == 1:
+                return index.search_node
+            current_node = self._get_search_result(index, parts[1], blocking)
+            depth = 2
+        while depth < len(parts):
+            child = current_node.get_child(parts[depth])
+            depth += 1
+            if child is None:
                 return None
+            if index.is_share_node(child):
+                # == 进入具体分享 ==
+                current_node = self._get_share_root(index, child, blocking)
+                if current_node is None:
+                    return None
+                break
+            current_node = child
 
-        # 构建分享虚拟目录
-        top_level_nodes = self._build_tree_from_share_code(shareCode)
-        share_root_node = FileNode(
-            id=int(codeHash[:8], 16),
-            parent_id=parent_id,
-            name=root_folder_name,
-            type=TYPE_DIRECTORY,
-            size=0,
-            etag=codeHash,
-            abs_path_str=root_folder_name,
-            children=top_level_nodes
-        )
-        for node in top_level_nodes:
-            node.parent = share_root_node
-        # 仅分享目录
-        if (SPLIT_FOLDER and len(parts) == 2) or (not SPLIT_FOLDER and len(parts) == 1):
-            return share_root_node
-        
         # 分享内部深层
-        current_node = share_root_node
-        idx_next = 2 if SPLIT_FOLDER else 1
-        for part in parts[idx_next:]:
-            found_child = None
-            for child in current_node.children:
-                if child.name == part:
-                    found_child = child
-                    break
+        for part in parts[depth:]:
+            found_child = current_node.get_child(part)
             if found_child:
                 current_node = found_child
             else:
@@ -1,72 +1,804 @@
-from Pan123 import Pan123
+from Pan123 import Pan123, setRequestDeadline
+from cache_store import CacheStore
 import base64
+import binascii
 import requests
 import yaml
 import os
 import json
 import time
+import threading
+import datetime
+import asyncio
+import math
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
 
-if not os.path.exists("cache.json"):
-    with open("cache.json", "w", encoding="utf-8") as f:
-        json.dump(
-            {
-                "accessToken": "",
-                "tokenCreateTime": "",
-                "lastDeleteTime": "",
-            },
-            f,
-            indent=4,
-            ensure_ascii=False)
-
-def get_file_url(name, etag, size) -> str:
-    # 读取配置文件
-    with open("settings.yaml", "r", encoding="utf-8") as f:
-        settings_data = yaml.safe_load(f.read())
-    # 实例化
-    driver = Pan123()
-    # 登录账号并保存Token（假设有效期24h）
-    with open("cache.json", "r", encoding="utf-8") as f:
-        cache_data = json.load(f)
-    if cache_data.get("tokenCreateTime") \
-        and time.time() - cache_data.get("tokenCreateTime") < 25 * 24 * 60 * 60 \
-        and cache_data.get("accessToken"): # accessToken 30天有效, 这里设置为25天, 省事
-        driver.setAccessToken(cache_data.get("accessToken"))
-    else:
-        driver.doLogin(
-            username=settings_data.get("123PAN_USERNAME"),
-            password=settings_data.get("123PAN_PASSWORD")
-        )
-        if driver.getAccessToken() is None:
-            print("登录失败, 请检查用户名或密码能否正常登录")
-            return "http://222.186.21.40:33333/NGGYU.mp4"
-        cache_data["accessToken"] = driver.getAccessToken()
-        cache_data["tokenCreateTime"] = int(time.time())
-        with open("cache.json", "w", encoding="utf-8") as f:
-            json.dump(cache_data, f, indent=4, ensure_ascii=False)
-    # 创建缓存文件夹
-    action_result = driver.createFolder(0, "__缓存目录_无视即可_24h自动清理__123Pan-Unlimited-WebDAV", True)
-    if action_result.get("isFinish"):
-        cacheFolderInfo = action_result.get("message").get("Info")
-        cacheFolderId = cacheFolderInfo.get("FileId")
-    else:
-        print(action_result.get("message"))
-        return "http://222.186.21.40:33333/NGGYU.mp4"
-    # 上传文件
-    action_result = driver.uploadFile(
-                            etag=etag,
-                            fileName=name,
-                            parentFileId=cacheFolderId,
-                            size=size,
-                            raw_data=True
-                        )
-    if action_result.get("isFinish"):
-        file_data = action_result.get("message").get("Info")
-        # print(action_result.get("message").get("Info"))
-    else:
-        print(action_result.get("message"))
-        return "http://222.186.21.40:33333/NGGYU.mp4"
-    # 获取下载地址
-    action_result = driver.downloadFile(
+with open("settings.yaml", "r", encoding="utf-8") as f:
+    settings_data = yaml.safe_load(f.read())
+# 下载链接缓存时间（秒），链接本身带有过期时间时取两者中较短的
+URL_CACHE_TTL = settings_data.get("URL_CACHE_TTL", 600)
+# 最多缓存多少个文件的下载链接
+URL_CACHE_SIZE = settings_data.get("URL_CACHE_SIZE", 2000)
+# 同时获取下载链接的最大线程数，超出的请求排队等待
+URL_RESOLVE_WORKERS = settings_data.get("URL_RESOLVE_WORKERS", 8)
+# 获取一个下载链接的最长等待时间（秒），超时后返回 504
+URL_RESOLVE_TIMEOUT = settings_data.get("URL_RESOLVE_TIMEOUT", 30)
+# 一次获取（含排队、重试和退避等待）的总时间上限，比 URL_RESOLVE_TIMEOUT 短，超时的获取在返回 504 前就计入熔断器
+URL_RESOLVE_BUDGET = max(URL_RESOLVE_TIMEOUT - 5, 1)
+# 检查最终链接时单次 HTTP 请求的超时时间（秒）
+URL_REQUEST_TIMEOUT = 10
+# 播放一个文件后，预先获取同一文件夹中接下来多少个媒体文件的下载链接，0 表示不预取
+PREFETCH_COUNT = settings_data.get("PREFETCH_COUNT", 0)
+# 预取使用的线程数（与正常请求分开，不占用 URL_RESOLVE_WORKERS）
+PREFETCH_WORKERS = 2
+# 获取下载链接失败时内部使用的返回值（不会再返回给客户端）
+FALLBACK_URL = "http://222.186.21.40:33333/NGGYU.mp4"
+# 获取某个文件的下载链接失败后，多少秒内不再重试该文件
+NEGATIVE_CACHE_TTL = settings_data.get("NEGATIVE_CACHE_TTL", 60)
+# 连续多少次获取下载链接失败后暂停请求123云盘
+CIRCUIT_BREAKER_THRESHOLD = settings_data.get("CIRCUIT_BREAKER_THRESHOLD", 5)
+# 暂停请求123云盘的时间（秒），期间直接返回 503，到期后先放行一个请求试探
+CIRCUIT_BREAKER_COOLDOWN = settings_data.get("CIRCUIT_BREAKER_COOLDOWN", 60)
+# 123云盘出错但未熔断时，建议客户端多少秒后重试
+UPSTREAM_RETRY_AFTER = 5
+# 链接过期前多少秒视为已失效，避免客户端拿到即将过期的链接
+URL_CACHE_EXPIRE_MARGIN = 60
+
+# 保存 accessToken 等状态的文件
+CACHE_FILE = "cache.json"
+# 是否把下载链接、缓存文件夹信息保存到 cache.db，重启后继续使用
+PERSIST_CACHE = settings_data.get("PERSIST_CACHE", True)
+CACHE_DB_FILE = "cache.db"
+# 网盘中用于获取下载链接的缓存文件夹
+CACHE_FOLDER_NAME = "__缓存目录_无视即可_24h自动清理__123Pan-Unlimited-WebDAV"
+# 无法从 accessToken 中读取过期时间时，按登录后 25 天过期处理（实际 30 天有效）
+TOKEN_DEFAULT_LIFETIME = 25 * 24 * 60 * 60
+# accessToken 剩余有效期不足该时间（秒）时，在后台提前重新登录
+TOKEN_REFRESH_BEFORE = 24 * 60 * 60
+# 后台检查 accessToken 有效期的间隔（秒）
+TOKEN_CHECK_INTERVAL = 60 * 60
+# 清理缓存文件夹的间隔（秒）
+CACHE_GC_INTERVAL = settings_data.get("CACHE_GC_INTERVAL", 60 * 60)
+# 缓存文件夹中的文件保留多久（秒），超过后删除
+CACHE_FILE_MAX_AGE = settings_data.get("CACHE_FILE_MAX_AGE", 24 * 60 * 60)
+# 缓存文件夹中最多保留的文件数，超出时先删除最早上传的
+CACHE_FILE_MAX_COUNT = settings_data.get("CACHE_FILE_MAX_COUNT", 1000)
+# 每次读取/删除的文件数
+CACHE_GC_BATCH_SIZE = 100
+# 账号连续失败多少次后暂停使用
+ACCOUNT_MAX_FAILURES = 3
+# 账号暂停使用的时间（秒），到期后自动恢复
+ACCOUNT_COOLDOWN = settings_data.get("ACCOUNT_COOLDOWN", 300)
+
+class UpstreamUnavailable(Exception):
+    """
+    暂时无法从123云盘获取下载链接，retry_after 秒后再试（WebDAV 返回 503 + Retry-After）
+    """
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+
+class CircuitBreaker:
+    """
+    熔断器: 连续失败 threshold 次后打开，cooldown 秒内直接拒绝；
+    到期后只放行一个试探请求，成功则恢复，失败则继续暂停
+    """
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def before_request(self, probe: bool = True):
+        """
+        熔断中时抛出 UpstreamUnavailable。
+        probe 为 False 时（如预取）不会作为试探请求放行，结果也不应通过 record 计入
+        """
+        self._check(probe, claim_probe=True)
+
+    def check(self):
+        """
+        熔断中或已有试探请求时抛出 UpstreamUnavailable，但不占用试探机会。
+        在排队等待获取线程之前调用，熔断期间的请求不必等待线程即可失败
+        """
+        self._check(probe=True, claim_probe=False)
+
+    def _check(self, probe: bool, claim_probe: bool):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.failures < self.threshold:
+                return
+            now = time.time()
+            if now < self.open_until:
+                raise UpstreamUnavailable("123云盘暂时不可用", self.open_until - now)
+            if self.probing or not probe:
+                raise UpstreamUnavailable("123云盘暂时不可用，正在重试", UPSTREAM_RETRY_AFTER)
+            if claim_probe:
+                self.probing = True
+
+    def retry_after(self) -> float:
+        """
+        熔断中时返回剩余秒数，否则返回 0
+        """
+        with self._lock:
+            if self.threshold <= 0 or self.failures < self.threshold:
+                return 0
+            return max(self.open_until - time.time(), 0)
+
+    def end_probe(self):
+        """
+        试探请求因与123云盘无关的原因结束时调用，不改变失败计数
+        """
+        with self._lock:
+            self.probing = False
+
+    def record(self, success: bool):
+        with self._lock:
+            self.probing = False
+            if success:
+                if self.failures >= self.threshold:
+                    print("123云盘已恢复，继续获取下载链接")
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.threshold > 0 and self.failures >= self.threshold:
+                self.open_until = time.time() + self.cooldown
+                print(f"连续 {self.failures} 次获取下载链接失败，{self.cooldown} 秒内暂停请求123云盘")
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "failures": self.failures,
+                "open": self.failures >= self.threshold > 0,
+                "retry_after": max(int(self.open_until - time.time()), 0),
+            }
+
+def _get_token_expire_time(token: str, token_create_time) -> float:
+    """
+    读取 accessToken (JWT) 中的过期时间 exp，无法读取时按登录时间估算
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        if exp:
+            return float(exp)
+    except (IndexError, ValueError, AttributeError, binascii.Error):
+        pass
+    try:
+        return float(token_create_time) + TOKEN_DEFAULT_LIFETIME
+    except (TypeError, ValueError):
+        return 0
+
+class Pan123Client:
+    """
+    进程内共用的123云盘客户端。
+    accessToken 和缓存文件夹保存在内存中，获取下载链接时不再读写文件、不再重复创建文件夹；
+    状态变化时才写入 cache.json（先写临时文件再替换）。
+    """
+    def __init__(self, username: str, password: str, cache_path: str = CACHE_FILE, store: Optional[CacheStore] = None):
+        self.username = username
+        self.password = password
+        self.cache_path = cache_path
+        self.store = store
+        self.driver = Pan123()
+        # 登录、创建缓存文件夹、写入 cache.json 时加锁，避免并发请求重复操作
+        self._lock = threading.Lock()
+        self.cache_data = self._load_cache()
+        # 正在使用该账号获取链接的请求数、连续失败次数、暂停使用截止时间（由 AccountPool 维护）
+        self.active = 0
+        self.failures = 0
+        self.benched_until = 0.0
+        self.token_expire_time = 0
+        if self.cache_data.get("accessToken"):
+            self.token_expire_time = _get_token_expire_time(self.cache_data["accessToken"], self.cache_data.get("tokenCreateTime"))
+            if self.token_expire_time > time.time():
+                self.driver.setAccessToken(self.cache_data["accessToken"])
+        # 缓存文件夹信息（createFolder 返回的 Info），首次使用时创建
+        self.cacheFolderInfo: Optional[dict] = None
+        # 缓存文件夹中已有的文件 {etag: 文件信息(FileId, S3KeyFlag 等)}，
+        # 上传后记录，清理缓存文件夹时按实际文件重建
+        self.inventory: Dict[str, dict] = {}
+        if self.store is not None:
+            self.cacheFolderInfo, self.inventory = self.store.load_cache_folder(self.username)
+        threading.Thread(target=self._refresh_token_loop, daemon=True).start()
+
+    def _load_cache(self) -> dict:
+        cache_data = {
+            "accessToken": "",
+            "tokenCreateTime": "",
+        }
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    saved_data = json.load(f)
+                # 账号变更后不再使用旧账号的 accessToken
+                if saved_data.get("username", self.username) == self.username:
+                    cache_data.update(saved_data)
+            except (OSError, ValueError) as e:
+                print(f"读取 {self.cache_path} 失败，将重新登录: {e}")
+        cache_data["username"] = self.username
+        return cache_data
+
+    def _save_cache(self):
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.cache_data, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+    def _login(self) -> bool:
+        self.driver.doLogin(username=self.username, password=self.password)
+        token = self.driver.getAccessToken()
+        if token is None:
+            return False
+        self.cache_data["accessToken"] = token
+        self.cache_data["tokenCreateTime"] = int(time.time())
+        self.token_expire_time = _get_token_expire_time(token, self.cache_data["tokenCreateTime"])
+        self._save_cache()
+        return True
+
+    def ensure_login(self) -> bool:
+        """
+        确保已登录且 accessToken 未过期
+        """
+        if self.driver.getAccessToken() and self.token_expire_time > time.time():
+            return True
+        with self._lock:
+            if self.driver.getAccessToken() and self.token_expire_time > time.time():
+                return True
+            return self._login()
+
+    def _refresh_token_loop(self):
+        """
+        后台定期检查，accessToken 即将过期时提前重新登录，避免在请求中等待登录
+        """
+        while True:
+            time.sleep(TOKEN_CHECK_INTERVAL)
+            if not self.driver.getAccessToken() or self.token_expire_time - time.time() > TOKEN_REFRESH_BEFORE:
+                continue
+            with self._lock:
+                if self._login():
+                    print("accessToken 即将过期，已重新登录")
+                else:
+                    print("accessToken 即将过期，重新登录失败, 请检查用户名或密码能否正常登录")
+
+    def get_cache_folder(self) -> Optional[dict]:
+        """
+        返回缓存文件夹信息，首次使用时创建
+        """
+        cacheFolderInfo = self.cacheFolderInfo
+        if cacheFolderInfo is not None:
+            return cacheFolderInfo
+        with self._lock:
+            if self.cacheFolderInfo is None:
+                action_result = self.driver.createFolder(0, CACHE_FOLDER_NAME, True)
+                if not action_result.get("isFinish"):
+                    print(action_result.get("message"))
+                    return None
+                self.cacheFolderInfo = action_result.get("message").get("Info")
+                if self.store is not None:
+                    self.store.put_cache_folder(self.username, self.cacheFolderInfo)
+            return self.cacheFolderInfo
+
+    def collect_garbage(self, protected_etags: set):
+        """
+        分页读取缓存文件夹，删除超过 CACHE_FILE_MAX_AGE 或超出 CACHE_FILE_MAX_COUNT 的文件，
+        protected_etags 中的文件（正在获取链接或链接仍在缓存中）不删除。返回删除的文件数
+        """
+        if not self.ensure_login():
+            return 0
+        protected_etags = {etag.lower() for etag in protected_etags}
+        cacheFolderInfo = self.get_cache_folder()
+        if cacheFolderInfo is None:
+            return 0
+        files = []
+        page = 1
+        while True:
+            action_result = self.driver.listFolderPage(cacheFolderInfo.get("FileId"), page, CACHE_GC_BATCH_SIZE)
+            if not action_result.get("isFinish"):
+                print(action_result.get("message"))
+                return 0
+            files.extend(action_result.get("message").get("InfoList"))
+            if action_result.get("message").get("isLastPage"):
+                break
+            page += 1
+        # files 按上传先后排序，超出数量上限的部分从最早的开始删除
+        over_count = max(len(files) - CACHE_FILE_MAX_COUNT, 0)
+        now = time.time()
+        expired = []
+        for number, item in enumerate(files):
+            if str(item.get("Etag")).lower() in protected_etags:
+                continue
+            if number < over_count or now - _get_upload_time(item, now) > CACHE_FILE_MAX_AGE:
+                expired.append(item)
+        deleted = 0
+        for start in range(0, len(expired), CACHE_GC_BATCH_SIZE):
+            batch = expired[start:start + CACHE_GC_BATCH_SIZE]
+            action_result = self.driver.deleteFile(batch, True)
+            if not action_result.get("isFinish"):
+                print(action_result.get("message"))
+                break
+            deleted += len(batch)
+        # 以缓存文件夹中实际剩余的文件为准重建索引（删除失败的文件仍保留）
+        deleted_ids = {item.get("FileId") for item in expired[:deleted]}
+        self.inventory = {
+            str(item.get("Etag")).lower(): item
+            for item in files
+            if item.get("FileId") not in deleted_ids and item.get("Type") == 0
+        }
+        if self.store is not None:
+            self.store.replace_files(self.username, self.inventory)
+        return deleted
+
+    def find_cached_file(self, etag: str, size: int) -> Optional[dict]:
+        """
+        缓存文件夹中 etag、大小都相同的文件信息，没有时返回 None
+        """
+        file_data = self.inventory.get(etag.lower())
+        if file_data is not None and file_data.get("Size") == size:
+            return file_data
+        return None
+
+    def remember_file(self, etag: str, file_data: dict):
+        self.inventory[etag.lower()] = file_data
+        if self.store is not None:
+            self.store.put_file(self.username, etag.lower(), file_data)
+
+    def forget_file(self, etag: str):
+        self.inventory.pop(etag.lower(), None)
+        if self.store is not None:
+            self.store.delete_file(self.username, etag.lower())
+
+    def invalidate_token(self):
+        """
+        accessToken 被123云盘拒绝时调用，下次使用时重新登录
+        """
+        self.token_expire_time = 0
+
+    def reset_cache_folder(self):
+        """
+        缓存文件夹被删除后调用，下次使用时重新创建
+        """
+        self.cacheFolderInfo = None
+        self.inventory = {}
+        if self.store is not None:
+            self.store.put_cache_folder(self.username, None)
+
+class AccountPool:
+    """
+    多个123云盘账号轮流获取下载链接: 优先使用正在处理的请求最少的账号，
+    连续失败的账号暂停使用 ACCOUNT_COOLDOWN 秒
+    """
+    def __init__(self, clients: List[Pan123Client]):
+        self.clients = clients
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Pan123Client:
+        with self._lock:
+            now = time.time()
+            available = [client for client in self.clients if client.benched_until <= now]
+            if not available:
+                # 全部暂停时使用最早恢复的账号
+                available = [min(self.clients, key=lambda client: client.benched_until)]
+            # 处理中的请求数相同时轮流使用
+            start = self._next % len(self.clients)
+            self._next += 1
+            client = min(available, key=lambda client: (client.active, (self.clients.index(client) - start) % len(self.clients)))
+            client.active += 1
+            return client
+
+    def release(self, client: Pan123Client, healthy: bool):
+        """
+        healthy 表示账号和123云盘是否正常（单个文件被拒绝不算账号的问题）
+        """
+        with self._lock:
+            client.active -= 1
+            if healthy:
+                client.failures = 0
+                return
+            client.failures += 1
+            if client.failures >= ACCOUNT_MAX_FAILURES:
+                client.benched_until = time.time() + ACCOUNT_COOLDOWN
+                client.failures = 0
+                print(f"账号 {client.username} 连续出错，暂停使用 {ACCOUNT_COOLDOWN} 秒")
+
+    def stats(self) -> List[Dict[str, object]]:
+        with self._lock:
+            now = time.time()
+            return [
+                {
+                    "username": client.username,
+                    "active": client.active,
+                    "failures": client.failures,
+                    "benched_seconds": max(int(client.benched_until - now), 0),
+                    "rates": client.driver.getRateStats(),
+                }
+                for client in self.clients
+            ]
+
+def _get_upload_time(item: dict, default: float) -> float:
+    """
+    文件上传到缓存文件夹的时间（Unix 时间），无法读取时返回 default
+    """
+    try:
+        return datetime.datetime.fromisoformat(item.get("CreateAt") or item.get("UpdateAt")).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+def _load_accounts() -> List[Tuple[str, str]]:
+    """
+    读取 123PAN_ACCOUNTS 中的全部账号，未配置时使用 123PAN_USERNAME / 123PAN_PASSWORD
+    """
+    accounts = [
+        (account.get("username"), account.get("password"))
+        for account in settings_data.get("123PAN_ACCOUNTS") or []
+        if account.get("username")
+    ]
+    if not accounts:
+        accounts = [(settings_data.get("123PAN_USERNAME"), settings_data.get("123PAN_PASSWORD"))]
+    return accounts
+
+cache_store = CacheStore(CACHE_DB_FILE) if PERSIST_CACHE else None
+
+# 第一个账号沿用 cache.json，其余账号依次使用 cache_2.json、cache_3.json……
+account_pool = AccountPool([
+    Pan123Client(
+        username=username,
+        password=password,
+        cache_path=CACHE_FILE if number == 1 else f"cache_{number}.json",
+        store=cache_store
+    )
+    for number, (username, password) in enumerate(_load_accounts(), start=1)
+])
+
+class UrlCache:
+    """
+    下载链接的 LRU 缓存，以 (etag, size) 为键，每个条目有各自的过期时间
+    """
+    def __init__(self, max_items: int, store: Optional[CacheStore] = None):
+        self.max_items = max_items
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Tuple[str, int], Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if self.store is not None:
+            # 上次运行时保存的、仍未过期的链接
+            for etag, size, url, expires in self.store.load_urls()[-max_items:] if max_items > 0 else []:
+                self._items[(etag, size)] = (expires, url)
+
+    def get(self, etag: str, size: int) -> Optional[str]:
+        with self._lock:
+            item = self._items.get((etag, size))
+            if item is None or item[0] <= time.time():
+                if item is not None:
+                    del self._items[(etag, size)]
+                self.misses += 1
+                return None
+            self._items.move_to_end((etag, size))
+            self.hits += 1
+            return item[1]
+
+    def put(self, etag: str, size: int, url: str, expires: float):
+        if self.max_items <= 0 or expires <= time.time():
+            return
+        with self._lock:
+            self._items[(etag, size)] = (expires, url)
+            self._items.move_to_end((etag, size))
+            while len(self._items) > self.max_items:
+                evicted_key, _ = self._items.popitem(last=False)
+                if self.store is not None:
+                    self.store.delete_url(*evicted_key)
+        if self.store is not None:
+            self.store.put_url(etag, size, url, expires)
+
+    def contains(self, etag: str, size: int) -> bool:
+        """
+        是否有未过期的链接（不影响命中统计和淘汰顺序）
+        """
+        with self._lock:
+            item = self._items.get((etag, size))
+            return item is not None and item[0] > time.time()
+
+    def live_etags(self) -> set:
+        """
+        链接尚未过期的文件的 etag
+        """
+        now = time.time()
+        with self._lock:
+            return {etag for (etag, _size), (expires, _url) in self._items.items() if expires > now}
+
+    def invalidate(self, etag: str, size: int):
+        with self._lock:
+            self._items.pop((etag, size), None)
+        if self.store is not None:
+            self.store.delete_url(etag, size)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "urls": len(self._items),
+                "max_urls": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+url_cache = UrlCache(URL_CACHE_SIZE, cache_store)
+
+def _get_url_expire_time(url: str) -> Optional[float]:
+    """
+    从签名链接的参数中读取过期时间（Unix 时间），无法识别时返回 None。
+    支持 auth_key=过期时间-随机数-uid-签名、Expires=过期时间、X-Amz-Date + X-Amz-Expires、t=过期时间
+    """
+    params = {key.lower(): values[0] for key, values in parse_qs(urlsplit(url).query).items()}
+    try:
+        if "auth_key" in params:
+            return float(params["auth_key"].split("-")[0])
+        if "expires" in params:
+            return float(params["expires"])
+        if "x-amz-date" in params and "x-amz-expires" in params:
+            signed_time = datetime.datetime.strptime(params["x-amz-date"], "%Y%m%dT%H%M%SZ").replace(tzinfo=datetime.timezone.utc)
+            return signed_time.timestamp() + float(params["x-amz-expires"])
+        if "t" in params:
+            return float(params["t"])
+    except ValueError:
+        return None
+    return None
+
+def _get_cache_expire_time(url: str) -> float:
+    """
+    计算链接在缓存中的过期时间: 默认缓存 URL_CACHE_TTL 秒，链接更早过期时提前失效
+    """
+    now = time.time()
+    expires = now + URL_CACHE_TTL
+    url_expires = _get_url_expire_time(url)
+    # 参数中的时间已经过去时，说明它是签发时间而不是过期时间，忽略
+    if url_expires is not None and url_expires > now:
+        expires = min(expires, url_expires - URL_CACHE_EXPIRE_MARGIN)
+    return expires
+
+circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN)
+# 最近获取失败的文件 {(etag, size): 可以重试的时间}
+_failed_files: "OrderedDict[Tuple[str, int], float]" = OrderedDict()
+_failed_files_lock = threading.Lock()
+
+def _check_failed_file(name, etag, size):
+    """
+    该文件最近获取失败过时抛出 UpstreamUnavailable
+    """
+    with _failed_files_lock:
+        retry_time = _failed_files.get((etag, size))
+        if retry_time is None:
+            return
+        if retry_time <= time.time():
+            del _failed_files[(etag, size)]
+            return
+    raise UpstreamUnavailable(f"{name} 获取下载链接失败", retry_time - time.time())
+
+def _remember_failed_file(etag, size):
+    if NEGATIVE_CACHE_TTL <= 0:
+        return
+    with _failed_files_lock:
+        _failed_files[(etag, size)] = time.time() + NEGATIVE_CACHE_TTL
+        _failed_files.move_to_end((etag, size))
+        while len(_failed_files) > URL_CACHE_SIZE:
+            _failed_files.popitem(last=False)
+
+# 最近因客户端要求而丢弃过链接的文件 {(etag, size): 丢弃的时间}
+_invalidated_files: "OrderedDict[Tuple[str, int], float]" = OrderedDict()
+_invalidated_files_lock = threading.Lock()
+
+# 正在获取中的下载链接 {(etag, size): Future}，同一文件的并发请求共用一次获取结果
+_inflight: Dict[Tuple[str, int], Future] = {}
+_inflight_lock = threading.Lock()
+
+# 在线程池中获取下载链接，避免阻塞 WebDAV 的事件循环
+_resolve_executor = ThreadPoolExecutor(max_workers=URL_RESOLVE_WORKERS, thread_name_prefix="get_file_url")
+# 预取下载链接的线程池，以及已排队等待预取的文件
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch_file_url")
+_prefetch_queued: set = set()
+_prefetch_lock = threading.Lock()
+
+def _collect_cache_garbage_loop():
+    """
+    后台定期清理各账号的缓存文件夹，不影响获取下载链接
+    """
+    while True:
+        time.sleep(CACHE_GC_INTERVAL)
+        for client in account_pool.clients:
+            # 正在获取链接、或链接仍在缓存中的文件不删除
+            with _inflight_lock:
+                protected_etags = {etag for etag, _size in _inflight}
+            protected_etags |= url_cache.live_etags()
+            try:
+                deleted = client.collect_garbage(protected_etags)
+            except Exception as e:
+                print(f"清理账号 {client.username} 的缓存文件夹失败: {e}")
+                continue
+            if deleted:
+                print(f"已清理账号 {client.username} 缓存文件夹中的 {deleted} 个文件")
+
+if CACHE_GC_INTERVAL > 0:
+    threading.Thread(target=_collect_cache_garbage_loop, daemon=True).start()
+
+def _prefetch_file_url(name, etag, size):
+    try:
+        get_file_url(name, etag, size, prefetch=True)
+    except Exception as e:
+        print(f"预取 {name} 的下载链接失败: {e}")
+    finally:
+        with _prefetch_lock:
+            _prefetch_queued.discard((etag, size))
+
+def prefetch_file_urls(files: List[Tuple[str, str, int]]):
+    """
+    在后台预先获取 files [(name, etag, size), ...] 的下载链接并写入缓存，
+    已缓存或已在排队的文件跳过。请求123云盘时同样受 Pan123 的限速控制
+    """
+    for name, etag, size in files:
+        if url_cache.contains(etag, size):
+            continue
+        with _prefetch_lock:
+            if (etag, size) in _prefetch_queued:
+                continue
+            _prefetch_queued.add((etag, size))
+        _prefetch_executor.submit(_prefetch_file_url, name, etag, size)
+
+def invalidate_file_url(etag, size):
+    """
+    客户端报告链接不可用（如带 no-cache 重新请求）时，丢弃该文件已缓存的链接。
+    有的客户端每次请求都带 no-cache，因此同一文件每 URL_CACHE_EXPIRE_MARGIN 秒最多丢弃一次；
+    最近失败的记录不清除，避免绕过失败缓存
+    """
+    now = time.time()
+    with _invalidated_files_lock:
+        if _invalidated_files.get((etag, size), 0) > now - URL_CACHE_EXPIRE_MARGIN:
+            return
+        _invalidated_files[(etag, size)] = now
+        _invalidated_files.move_to_end((etag, size))
+        while len(_invalidated_files) > URL_CACHE_SIZE:
+            _invalidated_files.popitem(last=False)
+    url_cache.invalidate(etag, size)
+
+def _join_or_start(name, etag, size) -> Tuple[Optional[str], Optional[Future], bool]:
+    """
+    查找缓存或正在进行的获取，返回 (缓存的链接, 共用的 Future, 是否由调用方负责获取)。
+    该文件最近失败过或123云盘熔断中时抛出 UpstreamUnavailable
+    """
+    cached_url = url_cache.get(etag, size)
+    if cached_url is not None:
+        print(f"使用缓存的 {name} 的真实 URL")
+        return cached_url, None, False
+    _check_failed_file(name, etag, size)
+    with _inflight_lock:
+        future = _inflight.get((etag, size))
+        if future is not None:
+            # 同一文件已在获取中，等待其结果
+            print(f"等待正在获取中的 {name} 的真实 URL")
+            return None, future, False
+        # 加锁后再确认一次，可能刚有其他请求获取完成
+        cached_url = url_cache.get(etag, size)
+        if cached_url is not None:
+            return cached_url, None, False
+        # 熔断中直接失败，不再登记 Future、排队等待线程
+        circuit_breaker.check()
+        future = Future()
+        _inflight[(etag, size)] = future
+        return None, future, True
+
+def _resolve_into_future(name, etag, size, future: Future, prefetch: bool, deadline: float):
+    """
+    获取下载链接并把结果（或异常）写入共用的 future，所有等待者都从 future 取得结果
+    """
+    try:
+        future.set_result(_resolve_with_circuit_breaker(name, etag, size, prefetch, deadline))
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _inflight_lock:
+            del _inflight[(etag, size)]
+
+def _resolve_with_circuit_breaker(name, etag, size, prefetch: bool, deadline: float) -> str:
+    circuit_breaker.before_request(probe=not prefetch)
+    try:
+        if time.monotonic() >= deadline:
+            # 排队等待线程期间已超时（线程都被卡住的请求占用）
+            raise _UpstreamError("等待获取下载链接超时")
+        final_url = _resolve_file_url(name, etag, size, deadline)
+    except (_UpstreamError, requests.RequestException) as e:
+        # 账号或123云盘出错（包括超时），计入熔断器
+        if not prefetch:
+            circuit_breaker.record(False)
+        raise UpstreamUnavailable(f"{name} 获取下载链接出错: {e}", circuit_breaker.retry_after() or UPSTREAM_RETRY_AFTER) from e
+    except Exception as e:
+        # 其他错误只与这个文件有关，不计入熔断器，记入该文件的失败缓存
+        if not prefetch:
+            circuit_breaker.end_probe()
+        _remember_failed_file(etag, size)
+        raise UpstreamUnavailable(f"{name} 获取下载链接出错: {e}", NEGATIVE_CACHE_TTL) from e
+    # 123云盘正常响应（即使该文件被拒绝）
+    if not prefetch:
+        circuit_breaker.record(True)
+    if not final_url or final_url == FALLBACK_URL:
+        # 只是这个文件无法获取（秒传失败、文件被屏蔽等），记入该文件的失败缓存
+        _remember_failed_file(etag, size)
+        raise UpstreamUnavailable(f"{name} 获取下载链接失败", NEGATIVE_CACHE_TTL)
+    url_cache.put(etag, size, final_url, _get_cache_expire_time(final_url))
+    return final_url
+
+def get_file_url(name, etag, size, prefetch=False) -> str:
+    """
+    获取文件的下载链接，优先使用缓存（在当前线程中阻塞执行）。
+    获取失败、该文件最近失败过或123云盘熔断中时抛出 UpstreamUnavailable。
+    prefetch 为 True 时（后台预取）结果不计入熔断器
+    """
+    cached_url, future, is_owner = _join_or_start(name, etag, size)
+    if cached_url is not None:
+        return cached_url
+    if is_owner:
+        _resolve_into_future(name, etag, size, future, prefetch, time.monotonic() + URL_RESOLVE_BUDGET)
+    return future.result()
+
+async def get_file_url_async(name, etag, size) -> str:
+    """
+    get_file_url 的异步版本: 缓存查找和并发合并在事件循环中完成，
+    只有负责获取的请求占用线程池，等待同一文件的其他请求不占用线程。
+    获取本身在 URL_RESOLVE_BUDGET 秒后放弃（抛出 UpstreamUnavailable 并计入熔断器），
+    等待超过 URL_RESOLVE_TIMEOUT 秒抛出 asyncio.TimeoutError。
+    调用方被取消（如客户端断开）时不再等待，后台获取到的链接仍会写入缓存。
+    """
+    cached_url, future, is_owner = _join_or_start(name, etag, size)
+    if cached_url is not None:
+        return cached_url
+    if is_owner:
+        # 截止时间从提交时算起，排队等待线程的时间也计算在内
+        _resolve_executor.submit(_resolve_into_future, name, etag, size, future, False, time.monotonic() + URL_RESOLVE_BUDGET)
+    # shield: 超时或取消时只停止等待，不取消其他请求共用的 future
+    return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=URL_RESOLVE_TIMEOUT)
+
+class _UpstreamError(Exception):
+    """
+    账号或123云盘本身的问题（登录失败、网络错误、5xx、限流、accessToken 失效），与具体文件无关
+    """
+
+def _raise_for_upstream_error(client: Pan123Client, action_result: dict):
+    """
+    Pan123 的请求因账号或123云盘的问题失败时抛出 _UpstreamError
+    """
+    errorType = action_result.get("errorType")
+    if errorType == "unauthorized":
+        # accessToken 已失效，下次重新登录
+        client.invalidate_token()
+    if errorType in ("upstream", "unauthorized"):
+        raise _UpstreamError(action_result.get("message"))
+
+def _resolve_file_url(name, etag, size, deadline: float) -> str:
+    """
+    使用账号池中的一个账号获取下载链接。
+    文件本身被拒绝时返回 FALLBACK_URL 或 None，账号或123云盘出错时抛出异常，只有后者计入账号的失败次数
+    """
+    client = account_pool.acquire()
+    healthy = True
+    # 123云盘无响应时，请求在截止时间到达后放弃，不会长时间占用线程
+    setRequestDeadline(deadline)
+    try:
+        return _resolve_file_url_with_client(client, name, etag, size, deadline)
+    except (_UpstreamError, requests.RequestException):
+        healthy = False
+        raise
+    finally:
+        setRequestDeadline(None)
+        account_pool.release(client, healthy=healthy)
+
+def _download_file(driver: Pan123, file_data: dict) -> dict:
+    return driver.downloadFile(
         etag=file_data.get("Etag"),
         fileId=file_data.get("FileId"),
         S3KeyFlag=file_data.get("S3KeyFlag"),
@@ -74,40 +806,88 @@ def get_file_url(name, etag, size) -> str:
         fileName=file_data.get("FileName"),
         size=file_data.get("Size")
     )
+
+def _resolve_file_url_with_client(client: Pan123Client, name, etag, size, deadline: float) -> str:
+    # 登录（已登录时直接使用内存中的 accessToken）
+    if not client.ensure_login():
+        raise _UpstreamError(f"账号 {client.username} 登录失败, 请检查用户名或密码能否正常登录")
+    # 获取缓存文件夹
+    cacheFolderInfo = client.get_cache_folder()
+    if cacheFolderInfo is None:
+        raise _UpstreamError(f"账号 {client.username} 创建缓存文件夹失败")
+    driver = client.driver
+    # 缓存文件夹中已有该文件时直接获取下载地址，不再重复上传
+    file_data = client.find_cached_file(etag, size)
+    if file_data is not None:
+        action_result = _download_file(driver, file_data)
+        _raise_for_upstream_error(client, action_result)
+        if not action_result.get("isFinish"):
+            # 文件可能已被删除，重新上传
+            print(action_result.get("message"))
+            client.forget_file(etag)
+            file_data = None
+    if file_data is None:
+        # 上传文件
+        action_result = driver.uploadFile(
+                                etag=etag,
+                                fileName=name,
+                                parentFileId=cacheFolderInfo.get("FileId"),
+                                size=size,
+                                raw_data=True
+                            )
+        if action_result.get("errorType") == "folderMissing":
+            # 缓存文件夹已被删除（如在网页端手动删除），重新创建后再上传一次
+            print(action_result.get("message"))
+            client.reset_cache_folder()
+            cacheFolderInfo = client.get_cache_folder()
+            if cacheFolderInfo is None:
+                raise _UpstreamError(f"账号 {client.username} 创建缓存文件夹失败")
+            action_result = driver.uploadFile(
+                                    etag=etag,
+                                    fileName=name,
+                                    parentFileId=cacheFolderInfo.get("FileId"),
+                                    size=size,
+                                    raw_data=True
+                                )
+        _raise_for_upstream_error(client, action_result)
+        if action_result.get("isFinish"):
+            file_data = action_result.get("message").get("Info")
+            client.remember_file(etag, file_data)
+            # print(action_result.get("message").get("Info"))
+        else:
+            # 只是这个文件上传失败（秒传失败、文件被屏蔽等），缓存文件夹和其中的其他文件不受影响
+            print(action_result.get("message"))
+            return FALLBACK_URL
+        # 获取下载地址
+        action_result = _download_file(driver, file_data)
+        _raise_for_upstream_error(client, action_result)
     if action_result.get("isFinish"):
         download_link = action_result.get("message")
         # print(download_link)
     else:
         print(action_result.get("message"))
-        return "http://222.186.21.40:33333/NGGYU.mp4"
-    # 删除文件夹
-    # 如果缓存里没有上次删除时间, 则把当前时间设置为上次删除时间
-    if not cache_data.get("lastDeleteTime"):
-        cache_data["lastDeleteTime"] = int(time.time())
-        with open("cache.json", "w", encoding="utf-8") as f:
-            json.dump(cache_data, f, indent=4, ensure_ascii=False)
-    # 现在缓存里一定有时间，判断间隔是否24小时，如果大于24小时则删除
-    if time.time() - cache_data.get("lastDeleteTime") > 24 * 60 * 60:
-        # 删除文件夹
-        action_result = driver.deleteFile([cacheFolderInfo], True)
-        if action_result.get("isFinish"):
-            print(f"彻底删除文件夹 {cacheFolderInfo.get('FileName')} 成功")
-            # print(action_result)
-        else:
-            print(action_result.get("message"))
-            return "http://222.186.21.40:33333/NGGYU.mp4"
-        # 缓存里的时间更新为当前时间
-        cache_data["lastDeleteTime"] = int(time.time())
-        with open("cache.json", "w", encoding="utf-8") as f:
-            json.dump(cache_data, f, indent=4, ensure_ascii=False) 
+        return FALLBACK_URL
     # 退出登录
     # driver.doLogout()
     # 获取跳转后的链接
-    real_url = download_link.split("params=")[-1].split("&")[0]
-    real_url = base64.b64decode(real_url).decode("utf-8")
+    try:
+        real_url = download_link.split("params=")[-1].split("&")[0]
+        real_url = base64.b64decode(real_url).decode("utf-8")
+    except (AttributeError, binascii.Error, UnicodeDecodeError) as e:
+        # 只是这个文件的下载地址格式不对，不是123云盘的问题
+        print(f"解析 {name} 的下载地址失败: {e}")
+        return None
     # 判断该链接是不是最终链接
     headers = {"Referer": "https://www.123pan.com/"}
-    response = requests.get(real_url, headers=headers, allow_redirects=False)
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise _UpstreamError("获取最终链接超时")
+    try:
+        response = requests.get(real_url, headers=headers, allow_redirects=False, timeout=min(URL_REQUEST_TIMEOUT, remaining))
+    except requests.RequestException as e:
+        raise _UpstreamError(f"获取最终链接失败: {e}") from e
+    if response.status_code >= 500:
+        raise _UpstreamError(f"获取最终链接失败: HTTP {response.status_code}")
     if response.status_code == 302:
         # 如果是 302 重定向，从 'Location' 头获取最终 URL
         final_url = response.headers.get("location")
@@ -116,7 +896,7 @@ def get_file_url(name, etag, size) -> str:
         try:
             data = response.json()
             final_url = data.get("data").get("redirect_url")
-        except requests.exceptions.JSONDecodeError:
+        except (ValueError, AttributeError):
             print("Status was 2xx, but failed to decode JSON response.")
             return None
     else:
@@ -1,8 +1,10 @@
 import uvicorn
 import yaml
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends
 from webdav_router import router as webdav_router
 from file_system import vfs
+from get_file_url import url_cache, account_pool, circuit_breaker
+from auth import verify_credentials
 
 # 读取配置文件
 with open("settings.yaml", "r", encoding="utf-8") as f:
@@ -16,6 +18,22 @@ app = FastAPI(
     redoc_url=None,
 )
 
+# 管理接口需要在 WebDAV 路由之前注册，否则 GET 会被 WebDAV 的通配路由接管
+@app.get("/__admin__/status", dependencies=[Depends(verify_credentials)], include_in_schema=False)
+async def admin_status():
+    """
+    查看当前索引版本、上次重建耗时、各项缓存命中情况、各账号状态
+    """
+    return {"index": vfs.reload_status, "tree_cache": vfs.tree_cache.stats(), "url_cache": url_cache.stats(), "accounts": account_pool.stats(), "circuit_breaker": circuit_breaker.stats()}
+
+@app.post("/__admin__/reload", dependencies=[Depends(verify_credentials)], include_in_schema=False)
+async def admin_reload():
+    """
+    手动触发后台重建索引（例如替换数据库文件后不想等待自动检测）
+    """
+    started = vfs.reload_in_background()
+    return {"started": started, "index": vfs.reload_status}
+
 app.include_router(webdav_router)
 
 if __name__ == "__main__":
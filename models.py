@@ -1,16 +1,17 @@
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 # 0 代表文件
 TYPE_FILE = 0
 # 1 代表目录
 TYPE_DIRECTORY = 1
 
-@dataclass
+@dataclass(slots=True)
 class FileNode:
     """
     数据类，用于表示文件系统中的一个节点（文件或目录）。
     使用 dataclass 可以自动生成 __init__, __repr__ 等方法，代码更简洁。
+    使用 slots 去掉每个节点的 __dict__，根目录和分桶下常驻的数万个节点因此更省内存。
     """
     # 节点的唯一ID
     id: int
@@ -29,4 +30,21 @@ class FileNode:
     # 节点的子节点列表，默认为空列表
     children: List['FileNode'] = field(default_factory=list)
     # 节点的父节点对象引用，默认为 None，在构建树时填充
-    parent: Optional['FileNode'] = None
\ No newline at end of file
+    parent: Optional['FileNode'] = None
+    # 节点的修改时间（已格式化为 HTTP 日期），分享内的文件/文件夹沿用分享的时间
+    last_modified: str = ""
+    # 目录节点的 {子节点名称: 子节点} 索引，在构建树时一次性生成，用于按路径逐级查找；文件节点不生成，保持为 None
+    children_index: Optional[Dict[str, 'FileNode']] = field(default=None, repr=False)
+
+    def build_children_index(self):
+        """
+        根据 children 重建名称索引。同名子节点只保留第一个，与逐个遍历查找的结果保持一致。
+        """
+        self.children_index = {}
+        for child in self.children:
+            self.children_index.setdefault(child.name, child)
+
+    def get_child(self, name: str) -> Optional['FileNode']:
+        if self.children_index is None:
+            return None
+        return self.children_index.get(name)
\ No newline at end of file
@@ -1,67 +1,304 @@
 from fastapi import APIRouter, Request, Response, HTTPException, status, Depends
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from urllib.parse import quote
-import datetime
-from xml.sax.saxutils import escape
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from xml.sax.saxutils import escape, quoteattr
+from xml.etree import ElementTree
+import asyncio
+import os
+import hashlib
+import mimetypes
+import threading
+import yaml
 
-from file_system import vfs
+from file_system import vfs, LookupWouldBlock
 from models import FileNode, TYPE_FILE, TYPE_DIRECTORY
-from get_file_url import get_file_url
+from get_file_url import get_file_url_async, invalidate_file_url, prefetch_file_urls, PREFETCH_COUNT, UpstreamUnavailable
 from auth import verify_credentials
 
+# 读取配置文件
+with open("settings.yaml", "r", encoding="utf-8") as f:
+    settings_data = yaml.safe_load(f.read())
+
 router = APIRouter()
 
 # WebDAV 响应需要的XML命名空间
 XML_NS = 'xmlns:D="DAV:"'
 
-def _build_propfind_response_xml(node: FileNode, href: str) -> str:
+# 流式返回 PROPFIND 响应时，每个数据块包含的节点数
+PROPFIND_CHUNK_SIZE = 200
+
+# PROPFIND 响应缓存容量（MB）
+PROPFIND_CACHE_SIZE_MB = settings_data.get('PROPFIND_CACHE_SIZE_MB', 64)
+# 预取下载链接的媒体文件扩展名
+MEDIA_EXTENSIONS = {
+    ".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm", ".m4v", ".ts", ".m2ts", ".mts",
+    ".rmvb", ".rm", ".mpg", ".mpeg", ".iso", ".mp3", ".flac", ".m4a", ".aac", ".wav", ".ape", ".ogg",
+}
+
+# 等待下载链接期间检查客户端是否已断开的间隔（秒）
+DISCONNECT_CHECK_INTERVAL = 0.5
+
+class PropfindCache:
+    """
+    已生成的 PROPFIND 响应的 LRU 缓存，键为 (索引版本, 请求路径, Depth, 请求的属性)，按字节数限制容量。
+    内容只读，只有数据库更新（索引版本变化）时才会变化，因此同一个键的响应内容固定不变。
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # 单个响应超过总容量的 1/4 时不缓存，避免一个超大目录挤掉所有缓存
+        self.max_entry_bytes = max_bytes // 4
+        self.total_bytes = 0
+        self._version = None
+        self._items: "OrderedDict[Tuple[str, ...], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, ...]) -> Optional[bytes]:
+        with self._lock:
+            body = self._items.get(key)
+            if body is not None:
+                self._items.move_to_end(key)
+            return body
+
+    def put(self, key: Tuple[str, ...], body: bytes):
+        if len(body) > self.max_entry_bytes:
+            return
+        # 在旧索引上开始、热更新后才发送完的响应不再放入缓存，避免清掉新版本已缓存的内容
+        if key[0] != vfs.index.version:
+            return
+        with self._lock:
+            # 索引版本变化后，旧版本的响应不会再被访问，直接清空
+            if key[0] != self._version:
+                self._items.clear()
+                self.total_bytes = 0
+                self._version = key[0]
+            if key in self._items:
+                self.total_bytes -= len(self._items.pop(key))
+            self._items[key] = body
+            self.total_bytes += len(body)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+propfind_cache = PropfindCache(max_bytes=PROPFIND_CACHE_SIZE_MB * 1024 * 1024)
+
+def _propfind_etag(key: Tuple[str, ...]) -> str:
+    """
+    PROPFIND 响应的强校验 ETag，由缓存键计算，无需等待响应生成即可得到
+    """
+    return '"' + hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest() + '"'
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    判断 If-None-Match 请求头是否包含当前 ETag
+    """
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def _iter_and_cache(key: Tuple[str, ...], chunks):
+    """
+    边发送边收集响应内容，完整发送后放入缓存
+    """
+    parts = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        if parts is not None:
+            parts.append(data)
+            size += len(data)
+            if size > propfind_cache.max_entry_bytes:
+                parts = None
+        yield data
+    if parts is not None:
+        propfind_cache.put(key, b"".join(parts))
+
+# 本服务支持的属性（均在 DAV: 命名空间下）
+SUPPORTED_PROPS = ("displayname", "resourcetype", "getcontentlength", "getlastmodified", "getetag")
+# propname 请求的返回内容，所有节点都相同
+PROPNAME_XML = "".join(f"<D:{name}/>" for name in SUPPORTED_PROPS)
+
+class PropfindRequest:
+    """
+    解析后的 PROPFIND 请求体。
+    - allprop: 返回全部属性（请求体为空时的默认行为）
+    - propname: 只返回属性名
+    - prop: 只返回请求的属性，不支持的属性放在 404 的 propstat 中
+    """
+    def __init__(self, mode: str = "allprop", requested: Tuple[Tuple[str, str], ...] = ()):
+        self.mode = mode
+        # 请求的属性中本服务支持的部分（按请求顺序）
+        self.found = [name for namespace, name in requested if namespace == "DAV:" and name in SUPPORTED_PROPS]
+        # 不支持的属性，每个节点都相同，提前拼接好
+        self.missing_xml = "".join(_render_empty_prop(namespace, name) for namespace, name in requested if not (namespace == "DAV:" and name in SUPPORTED_PROPS))
+        # 用于响应缓存键和 ETag
+        self.cache_key = mode if mode != "prop" else "prop:" + ",".join(f"{{{namespace}}}{name}" for namespace, name in requested)
+
+def _render_empty_prop(namespace: str, name: str) -> str:
+    if namespace == "DAV:":
+        return f"<D:{name}/>"
+    return f'<{name} xmlns={quoteattr(namespace)}/>'
+
+def _parse_propfind_body(body: bytes) -> PropfindRequest:
+    """
+    解析 PROPFIND 请求体，请求体不是合法的 XML 时抛出 ValueError
+    """
+    if not body.strip():
+        return PropfindRequest()
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError as e:
+        raise ValueError(f"PROPFIND 请求体解析失败: {e}")
+    if root.tag != "{DAV:}propfind":
+        raise ValueError("PROPFIND 请求体的根元素必须是 DAV:propfind")
+    for child in root:
+        if child.tag == "{DAV:}propname":
+            return PropfindRequest("propname")
+        if child.tag == "{DAV:}prop":
+            requested = []
+            for prop in child:
+                # 标签形如 {namespace}name，没有命名空间时只有 name
+                namespace, _, name = prop.tag[1:].rpartition("}") if prop.tag.startswith("{") else ("", "", prop.tag)
+                if (namespace, name) not in requested:
+                    requested.append((namespace, name))
+            return PropfindRequest("prop", tuple(requested))
+    return PropfindRequest()
+
+def _render_prop(name: str, node: FileNode) -> str:
+    """
+    生成单个属性的 XML
+    """
+    if name == "displayname":
+        # 使用 escape() 对文件名进行 XML 转义，防止非法字符破坏XML结构
+        return f"<D:displayname>{escape(node.name)}</D:displayname>"
+    if name == "resourcetype":
+        # 根据节点类型设置 resourcetype
+        return "<D:resourcetype><D:collection/></D:resourcetype>" if node.type == TYPE_DIRECTORY else "<D:resourcetype/>"
+    if name == "getcontentlength":
+        return f"<D:getcontentlength>{node.size}</D:getcontentlength>"
+    if name == "getlastmodified":
+        return f"<D:getlastmodified>{node.last_modified}</D:getlastmodified>"
+    # 文件的 ETag (对于目录可以为空)
+    return f'<D:getetag>"{node.etag}"</D:getetag>' if node.etag else '<D:getetag/>'
+
+def _build_propfind_response_xml(node: FileNode, href: str, propfind: PropfindRequest) -> str:
     """
     为单个节点生成 PROPFIND 响应中的 <D:response> XML 片段。
     
     Args:
         node (FileNode): 要为其生成 XML 的文件/目录节点。
         href (str): 此节点在 WebDAV 服务器上的绝对路径 (如 / 或 /some_dir/file.mkv)。
+        propfind (PropfindRequest): 客户端请求的属性。
     """
     # 确保目录的 href 总是以斜杠结尾
     final_href = href
     if node.type == TYPE_DIRECTORY and not final_href.endswith('/'):
         final_href += '/'
-    
-    # 根据节点类型设置 resourcetype
-    if node.type == TYPE_DIRECTORY:
-        resourcetype = "<D:resourcetype><D:collection/></D:resourcetype>"
+
+    if propfind.mode == "propname":
+        props_xml = PROPNAME_XML
+    elif propfind.mode == "prop":
+        props_xml = "".join(_render_prop(name, node) for name in propfind.found)
     else:
-        resourcetype = "<D:resourcetype/>"
+        props_xml = "".join(_render_prop(name, node) for name in SUPPORTED_PROPS)
+
+    # 请求了不支持的属性时，附加一个 404 的 propstat
+    missing_xml = ""
+    if propfind.missing_xml:
+        missing_xml = f"""
+        <D:propstat>
+            <D:prop>{propfind.missing_xml}</D:prop>
+            <D:status>HTTP/1.1 404 Not Found</D:status>
+        </D:propstat>"""
 
-    # 文件的 ETag (对于目录可以为空)
-    etag_xml = f'<D:getetag>"{node.etag}"</D:getetag>' if node.etag else '<D:getetag/>'
-    
-    # 统一使用一个固定的时间戳，因为我们的文件系统是虚拟的且只读
-    now_iso = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-    
-    # 使用 escape() 对文件名进行 XML 转义，防止非法字符破坏XML结构
-    display_name = escape(node.name)
-    
     # 拼接单个节点的 propfind 响应 XML
     return f"""
     <D:response>
         <D:href>{final_href}</D:href>
         <D:propstat>
-            <D:prop>
-                <D:displayname>{display_name}</D:displayname>
-                {resourcetype}
-                <D:getcontentlength>{node.size}</D:getcontentlength>
-                <D:getlastmodified>{now_iso}</D:getlastmodified>
-                {etag_xml}
-            </D:prop>
+            <D:prop>{props_xml}</D:prop>
             <D:status>HTTP/1.1 200 OK</D:status>
-        </D:propstat>
+        </D:propstat>{missing_xml}
     </D:response>
     """
 
+def _iter_propfind_multistatus_xml(node: FileNode, request_href: str, depth: str, propfind: PropfindRequest):
+    """
+    逐块生成完整的 Multi-Status XML，避免大目录在内存中拼接出整个响应
+    """
+    yield f"""<?xml version="1.0" encoding="utf-8"?>
+<D:multistatus {XML_NS}>
+"""
+    # 为请求的节点本身生成 XML
+    yield _build_propfind_response_xml(node, request_href, propfind)
+
+    # 如果是目录且查询深度为 "1"，则为其子节点也生成 XML
+    if depth == "1" and node.type == TYPE_DIRECTORY:
+        # 确保父路径以 '/' 结尾
+        parent_href = request_href if request_href.endswith('/') else request_href + '/'
+        chunk = []
+        for child in node.children:
+            # 构造子节点的 href
+            child_href = f"{parent_href}{quote(child.name)}"
+            chunk.append(_build_propfind_response_xml(child, child_href, propfind))
+            if len(chunk) >= PROPFIND_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+    yield """
+</D:multistatus>
+"""
+
+async def _wait_for_disconnect(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_CHECK_INTERVAL)
+
+async def _get_file_url_unless_disconnected(request: Request, node: FileNode) -> Optional[str]:
+    """
+    获取文件的下载链接，客户端在此期间断开时返回 None，超时返回 504
+    """
+    resolve_task = asyncio.ensure_future(get_file_url_async(node.name, node.etag, node.size))
+    disconnect_task = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait({resolve_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect_task.cancel()
+    if not resolve_task.done():
+        resolve_task.cancel()
+        return None
+    try:
+        return resolve_task.result()
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="获取下载链接超时")
+
+def _is_media_file(node: FileNode) -> bool:
+    return node.type == TYPE_FILE and os.path.splitext(node.name)[1].lower() in MEDIA_EXTENSIONS
+
+def _get_next_media_files(node: FileNode, count: int) -> List[FileNode]:
+    """
+    同一文件夹中按名称排在 node 之后的 count 个媒体文件（通常是接下来的几集）
+    """
+    if node.parent is None or not _is_media_file(node):
+        return []
+    media_files = sorted((child for child in node.parent.children if _is_media_file(child)), key=lambda child: child.name)
+    for number, child in enumerate(media_files):
+        if child is node:
+            return media_files[number + 1:number + 1 + count]
+    return []
+
 @router.api_route(
     "/{path:path}",
-    methods=["PROPFIND", "GET", "OPTIONS"],
+    methods=["PROPFIND", "GET", "HEAD", "OPTIONS"],
     dependencies=[Depends(verify_credentials)], # 对所有方法应用认证
     summary="WebDAV 主处理程序",
     tags=["WebDAV"]
@@ -72,6 +309,7 @@ async def handle_webdav_request(request: Request, path: str):
     - OPTIONS: 返回服务器支持的方法。
     - PROPFIND: 返回目录列表或文件属性。
     - GET: 对文件请求进行重定向。
+    - HEAD: 直接返回文件的元数据，不获取下载链接。
     """
     client_ip = request.client.host
     method = request.method
@@ -80,54 +318,101 @@ async def handle_webdav_request(request: Request, path: str):
     # --- 处理 OPTIONS 请求 ---
     if method == "OPTIONS":
         headers = {
-            "Allow": "OPTIONS, GET, PROPFIND",
+            "Allow": "OPTIONS, GET, HEAD, PROPFIND",
             "DAV": "1"
         }
         return Response(status_code=status.HTTP_200_OK, headers=headers)
 
     # --- 获取请求的节点 ---
-    node = vfs.get_node_by_path(path)
+    # 同一请求内使用同一版本的索引（响应缓存也以该版本为键）
+    index = vfs.index
+    try:
+        # 目录树和搜索结果都已缓存时，直接在事件循环中查找
+        node = vfs.get_node_by_path(path, index, blocking=False)
+    except LookupWouldBlock:
+        # 需要查询数据库或解码 shareCode，放到线程池中执行，避免阻塞其他请求
+        node = await run_in_threadpool(vfs.get_node_by_path, path, index)
     if not node:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="资源未找到")
 
+    # --- 处理 HEAD 请求 ---
+    # 只用虚拟文件系统中的信息回答，不访问123云盘
+    if method == "HEAD":
+        if node.type == TYPE_DIRECTORY:
+            raise HTTPException(status_code=status.HTTP_405_METHOD_NOT_ALLOWED, detail="不支持HEAD目录")
+        headers = {
+            "Content-Length": str(node.size),
+            "Content-Type": mimetypes.guess_type(node.name)[0] or "application/octet-stream",
+            "Accept-Ranges": "bytes",
+            "Last-Modified": node.last_modified
+        }
+        if node.etag:
+            headers["ETag"] = f'"{node.etag}"'
+        return Response(status_code=status.HTTP_200_OK, headers=headers)
+
     # --- 处理 GET 请求 ---
     if method == "GET":
         if node.type == TYPE_FILE:
             print(f"GET文件: {node.name} {node.etag}")
-            real_url = get_file_url(node.name, node.etag, node.size)
+            # 客户端要求不使用缓存（通常是上次拿到的链接已失效），重新获取链接（同一文件有频率限制）
+            if "no-cache" in request.headers.get("Cache-Control", "") or "no-cache" in request.headers.get("Pragma", ""):
+                invalidate_file_url(node.etag, node.size)
+            try:
+                real_url = await _get_file_url_unless_disconnected(request, node)
+            except UpstreamUnavailable as e:
+                # 不再返回占位视频，让客户端稍后重试
+                print(f"暂时无法获取下载链接: {e}")
+                return Response(
+                    content=str(e),
+                    media_type="text/plain; charset=utf-8",
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+            if real_url is None:
+                print(f"客户端已断开，停止等待: {node.name}")
+                return Response(status_code=499)
+            # 当前文件的链接获取完成后，再在后台预取接下来几集的链接
+            if PREFETCH_COUNT > 0:
+                prefetch_file_urls([(child.name, child.etag, child.size) for child in _get_next_media_files(node, PREFETCH_COUNT)])
             return RedirectResponse(url=real_url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
         elif node.type == TYPE_DIRECTORY:
             raise HTTPException(status_code=status.HTTP_405_METHOD_NOT_ALLOWED, detail="不支持GET目录")
         
     # --- 处理 PROPFIND 请求 ---
     if method == "PROPFIND":
-        depth = request.headers.get("Depth", "1")
-        
-        responses_xml = ""
-        
+        # 只有 Depth 为 "1" 时才列出子节点，其余情况只返回节点本身
+        depth = "1" if request.headers.get("Depth", "1") == "1" else "0"
+
         # 使用 request.url.path 来获取请求的原始路径，确保根目录的 href 正确
         # request.url.path 会保留原始的路径，例如 / 或 /Specials/
         request_href = request.url.path
 
-        # 为请求的节点本身生成 XML
-        responses_xml += _build_propfind_response_xml(node, request_href)
+        # 解析请求体，只返回客户端需要的属性
+        try:
+            propfind = _parse_propfind_body(await request.body())
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
-        # 如果是目录且查询深度为 "1"，则为其子节点也生成 XML
-        if depth == "1" and node.type == TYPE_DIRECTORY:
-            # 确保父路径以 '/' 结尾
-            parent_href = request_href if request_href.endswith('/') else request_href + '/'
-            for child in node.children:
-                # 构造子节点的 href
-                child_href = f"{parent_href}{quote(child.name)}"
-                responses_xml += _build_propfind_response_xml(child, child_href)
+        cache_key = (index.version, request_href, depth, propfind.cache_key)
+        etag = _propfind_etag(cache_key)
+        headers = {"ETag": etag}
 
-        # 完整的 Multi-Status XML 响应
-        full_xml = f"""<?xml version="1.0" encoding="utf-8"?>
-<D:multistatus {XML_NS}>
-{responses_xml}
-</D:multistatus>
-"""
-        return Response(content=full_xml, media_type="application/xml; charset=utf-8", status_code=207)
+        # 客户端已有相同内容
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        # 命中缓存直接返回
+        body = propfind_cache.get(cache_key)
+        if body is not None:
+            return Response(content=body, media_type="application/xml; charset=utf-8", status_code=207, headers=headers)
+
+        return StreamingResponse(
+            _iter_and_cache(cache_key, _iter_propfind_multistatus_xml(node, request_href, depth, propfind)),
+            media_type="application/xml; charset=utf-8",
+            status_code=207,
+            headers=headers
+        )
 
     # 如果是其他未实现的方法
     raise HTTPException(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
\ No newline at end of file